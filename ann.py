@@ -0,0 +1,55 @@
+import numpy as np
+
+
+class L1PartitionIndex:
+    """Partitioned L1 nearest-neighbor index over entity embeddings.
+
+    The embeddings are clustered with k-medians under the L1 distance, a search probes the partitions whose
+    medians are closest to the query and ranks their members exactly.
+    """
+    def __init__(self, embeddings, num_partitions, num_iterations=10, seed=0, chunk_size=256):
+        self.embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        self.chunk_size = chunk_size
+        num_partitions = min(num_partitions, len(self.embeddings))
+        rng = np.random.default_rng(seed)
+        self.centroids = self.embeddings[rng.choice(len(self.embeddings), num_partitions, replace=False)].copy()
+        for _ in range(num_iterations):
+            assignment = self.assign(self.embeddings)
+            for partition in range(num_partitions):
+                members = self.embeddings[assignment == partition]
+                if len(members) > 0:
+                    self.centroids[partition] = np.median(members, axis=0)
+
+        assignment = self.assign(self.embeddings)
+        self.ids = np.argsort(assignment, kind='stable')
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=num_partitions))])
+
+    def l1_distance(self, queries, embeddings):
+        distances = [np.abs(chunk[:, None, :] - embeddings[None, :, :]).sum(-1)
+                     for chunk in np.array_split(queries, max(1, len(queries) // self.chunk_size))]
+        return np.concatenate(distances, axis=0)
+
+    def assign(self, embeddings):
+        return self.l1_distance(embeddings, self.centroids).argmin(-1)
+
+    def search(self, queries, k, num_probe):
+        """Approximate top-k entities by L1 distance, returns (ids, distances) of shape len(queries) x k.
+
+        Rows with fewer than k members in the probed partitions are padded with id -1 at an infinite distance.
+        """
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        num_probe = min(num_probe, len(self.centroids))
+        probes = np.argpartition(self.l1_distance(queries, self.centroids), num_probe - 1, axis=-1)[:, :num_probe]
+
+        all_ids = np.full((len(queries), k), -1, dtype=np.int64)
+        all_distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        for i, probe in enumerate(probes):
+            ids = np.concatenate([self.ids[self.offsets[partition]:self.offsets[partition+1]] for partition in probe])
+            distances = np.abs(self.embeddings[ids] - queries[i]).sum(-1)
+            if len(ids) > k:
+                top = np.argpartition(distances, k - 1)[:k]
+                ids, distances = ids[top], distances[top]
+            order = np.argsort(distances)
+            all_ids[i, :len(ids)] = ids[order]
+            all_distances[i, :len(ids)] = distances[order]
+        return all_ids, all_distances
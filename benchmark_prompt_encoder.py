@@ -0,0 +1,109 @@
+import argparse
+import time
+import numpy as np
+import torch
+from collections import defaultdict
+from torch.utils.data import DataLoader
+
+from main import parse_args, load_data, build_train_iterator, build_relation_mat, load_kge_pretrain, query_name_dict
+from dataloader import TestDataset
+from models import KGReasoning
+from neighborGraph import neighborGraph
+from util import flatten_query, set_global_seed, eval_tuple
+
+
+def benchmark(encoder, args, mat, inductiveGraph, train_queries, train_answers, valid_queries, valid_answers, valid_easy_answers):
+    """Train one model with the given prompt encoder and return its step time, eval throughput and MRR."""
+    args.prompt_encoder = encoder
+    set_global_seed(args.seed)
+    model = KGReasoning(
+        nentity=args.nentity,
+        nrelation=args.nrelation,
+        hidden_dim=args.hidden_dim,
+        gamma=args.gamma,
+        geo=args.geo,
+        mode=args.kge_mode,
+        use_cuda=args.cuda,
+        box_mode=eval_tuple(args.box_mode),
+        beta_mode=eval_tuple(args.beta_mode),
+        query_name_dict=query_name_dict,
+        mat=mat,
+        inductiveGraph=inductiveGraph,
+        loss_weight=args.loss_weight,
+        args=args
+    )
+    if args.cuda:
+        model = model.cuda()
+    if args.KGE_pretrain:
+        load_kge_pretrain(model, args)
+    num_params = sum(param.numel() for param in model.bert.parameters())
+
+    optimizer = torch.optim.Adam(filter(lambda p: p.requires_grad, model.parameters()), lr=args.learning_rate)
+    train_iterator = build_train_iterator(train_queries, train_answers, None, args)
+    for step in range(args.warmup_steps + args.bench_steps):
+        if step == args.warmup_steps:
+            if args.cuda:
+                torch.cuda.synchronize()
+            start = time.time()
+        model.train_step(model, optimizer, train_iterator, args, step)
+    if args.cuda:
+        torch.cuda.synchronize()
+    step_time = (time.time() - start) / args.bench_steps
+
+    dataloader = DataLoader(
+        TestDataset(valid_queries, args.nentity, args.nrelation),
+        batch_size=args.test_batch_size,
+        num_workers=args.cpu_num,
+        collate_fn=TestDataset.collate_fn
+    )
+    start = time.time()
+    metrics = model.test_step(model, valid_easy_answers, valid_answers, args, dataloader)
+    throughput = len(valid_queries) / (time.time() - start)
+    mrr = np.mean([metrics[query_structure]['MRR'] for query_structure in metrics])
+    return num_params, step_time, throughput, mrr
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Step time, eval throughput and MRR of every prompt encoder backend, '
+                                                 'the remaining arguments are passed to main.py\'s parser')
+    parser.add_argument('--encoders', default='bert,gru,transformer', type=str)
+    parser.add_argument('--bench_steps', default=200, type=int, help='timed training steps per encoder')
+    parser.add_argument('--warmup_steps', default=10, type=int, help='untimed training steps before the timing starts')
+    parser.add_argument('--split', default='se', type=str, choices=['ee', 'es', 'se'], help='validation split used for throughput and MRR')
+    bench_args, rest = parser.parse_known_args()
+    args = parse_args(rest)
+    args.bench_steps, args.warmup_steps = bench_args.bench_steps, bench_args.warmup_steps
+
+    with open('%s/stats.txt' % args.data_path) as f:
+        entrel = f.readlines()
+        args.nentity = int(entrel[0].split(' ')[-1])
+        args.nrelation = int(entrel[1].split(' ')[-1])
+
+    tasks = args.tasks.split('.')
+    train_queries, train_answers, valid_ee_queries, valid_es_queries, valid_se_queries, valid_ee_answers, valid_es_answers, valid_se_answers, \
+        _, _, _, _, _, _, valid_ee_easy_answers, valid_es_easy_answers, valid_se_easy_answers, _, _, _ = load_data(args, tasks)
+    valid_queries, valid_answers, valid_easy_answers = {
+        'ee': (valid_ee_queries, valid_ee_answers, valid_ee_easy_answers),
+        'es': (valid_es_queries, valid_es_answers, valid_es_easy_answers),
+        'se': (valid_se_queries, valid_se_answers, valid_se_easy_answers),
+    }[bench_args.split]
+
+    path_queries = defaultdict(set)
+    for query_structure in train_queries:
+        if query_name_dict[query_structure] in ['1p', '2p', '3p']:
+            path_queries[query_structure] = train_queries[query_structure]
+    mat = build_relation_mat(args)
+    inductiveGraph = neighborGraph(args)
+
+    results = []
+    for encoder in bench_args.encoders.split(','):
+        results.append((encoder,) + benchmark(encoder, args, mat, inductiveGraph, flatten_query(path_queries), train_answers,
+                                              flatten_query(valid_queries), valid_answers, valid_easy_answers))
+
+    print('%-12s %12s %14s %18s %8s' % ('encoder', 'parameters', 'step time (s)', 'eval queries / s', 'MRR'))
+    for encoder, num_params, step_time, throughput, mrr in results:
+        print('%-12s %12d %14.4f %18.1f %8.4f' % (encoder, num_params, step_time, throughput, mrr))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,15 +2,17 @@
 import numpy as np
 import torch
 
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 from util import list2tuple, tuple2list, flatten
 
 class TestDataset(Dataset):
-    def __init__(self, queries, nentity, nrelation):
+    def __init__(self, queries, nentity, nrelation, candidates=None):
         self.len = len(queries)
         self.queries = queries
         self.nentity = nentity
         self.nrelation = nrelation
+        # None ranks against all entities, which the model provides on its own device
+        self.candidates = None if candidates is None else torch.LongTensor(candidates)
 
     def __len__(self):
         return self.len
@@ -18,19 +20,25 @@ class TestDataset(Dataset):
     def __getitem__(self, idx):
         query = self.queries[idx][0]
         query_structure = self.queries[idx][1]
-        negative_sample = torch.LongTensor(range(self.nentity))
-        return negative_sample, flatten(query), query, query_structure
+        # queries merged from several splits carry the split as a third element
+        split = self.queries[idx][2] if len(self.queries[idx]) > 2 else None
+        negative_sample = self.candidates
+        return negative_sample, flatten(query), query, query_structure, split
 
     @staticmethod
     def collate_fn(data):
-        negative_sample = torch.stack([_[0] for _ in data], dim=0)
+        if data[0][0] is None:
+            negative_sample = None
+        else:
+            negative_sample = torch.stack([_[0] for _ in data], dim=0)
         query = [_[1] for _ in data]
         query_unflatten = [_[2] for _ in data]
         query_structure = [_[3] for _ in data]
-        return negative_sample, query, query_unflatten, query_structure
+        split = [_[4] for _ in data]
+        return negative_sample, query, query_unflatten, query_structure, split
 
 class TrainDataset(Dataset):
-    def __init__(self, queries, nentity, nrelation, negative_sample_size, answer):
+    def __init__(self, queries, nentity, nrelation, negative_sample_size, answer, partition=None, cross_partition_ratio=0.):
         self.len = len(queries)
         self.queries = queries
         self.nentity = nentity
@@ -38,6 +46,12 @@ class TrainDataset(Dataset):
         self.negative_sample_size = negative_sample_size
         self.count = self.count_frequency(queries, answer)
         self.answer = answer
+        # with an entity partition, negatives are mostly drawn from the partition of the query anchor
+        self.partition = partition
+        self.cross_partition_ratio = cross_partition_ratio
+        if partition is not None:
+            order = np.argsort(partition, kind='stable')
+            self.partition_members = np.split(order, np.cumsum(np.bincount(partition))[:-1])
 
     def __len__(self):
         return self.len
@@ -51,7 +65,10 @@ class TrainDataset(Dataset):
         negative_sample_list = []
         negative_sample_size = 0
         while negative_sample_size < self.negative_sample_size:
-            negative_sample = np.random.randint(self.nentity, size=self.negative_sample_size*2)
+            if self.partition is not None and len(negative_sample_list) == 0:
+                negative_sample = self.partition_negative_sample(query)
+            else:
+                negative_sample = np.random.randint(self.nentity, size=self.negative_sample_size*2)
             mask = np.in1d(
                 negative_sample,
                 self.answer[query],
@@ -76,6 +93,13 @@ class TrainDataset(Dataset):
         query_structure = [_[4] for _ in data]
         return positive_sample, negative_sample, subsample_weight, query, query_structure
 
+    def partition_negative_sample(self, query):
+        # only the first draw is partition-local, so a partition made of answers cannot stall the sampling
+        members = self.partition_members[self.partition[flatten(query)[0]]]
+        num_cross = np.random.binomial(self.negative_sample_size*2, self.cross_partition_ratio)
+        return np.concatenate([np.random.choice(members, size=self.negative_sample_size*2-num_cross),
+                               np.random.randint(self.nentity, size=num_cross)])
+
     @staticmethod
     def count_frequency(queries, answer, start=4):
         count = {}
@@ -83,6 +107,35 @@ class TrainDataset(Dataset):
             count[query] = start + len(answer[query])
         return count
 
+class PartitionBatchSampler(Sampler):
+    """Batches of training queries whose anchors come from partitions_per_batch partitions at a time.
+
+    Every epoch visits the partitions in a new random order and the queries of each group of partitions
+    in a new random order, the queries left over at the end of a group start the next batch.
+    """
+    def __init__(self, queries, partition, batch_size, partitions_per_batch):
+        anchor_partition = np.array([partition[flatten(query)[0]] for query, _ in queries], dtype=np.int64)
+        order = np.argsort(anchor_partition, kind='stable')
+        self.groups = [group for group in np.split(order, np.cumsum(np.bincount(anchor_partition))[:-1]) if len(group) > 0]
+        self.len = len(queries)
+        self.batch_size = batch_size
+        self.partitions_per_batch = partitions_per_batch
+
+    def __len__(self):
+        return (self.len + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        groups = [self.groups[i] for i in np.random.permutation(len(self.groups))]
+        left = np.zeros(0, dtype=np.int64)
+        for i in range(0, len(groups), self.partitions_per_batch):
+            idxs = np.concatenate([left, np.random.permutation(np.concatenate(groups[i:i+self.partitions_per_batch]))])
+            num_full = len(idxs) // self.batch_size * self.batch_size
+            for start in range(0, num_full, self.batch_size):
+                yield idxs[start:start+self.batch_size].tolist()
+            left = idxs[num_full:]
+        if len(left) > 0:
+            yield left.tolist()
+
 class SingledirectionalOneShotIterator(object):
     def __init__(self, dataloader):
         self.iterator = self.one_shot_iterator(dataloader)
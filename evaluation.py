@@ -0,0 +1,211 @@
+import collections
+import copy
+import traceback
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader
+from dataloader import TestDataset
+
+
+def pack_answers(queries, easy_answers, answers, device):
+    """Pack the easy and hard answers of a batch into a padded index tensor with validity and hard-answer masks."""
+    answer_lists = [list(easy_answers[query]) + list(answers[query]) for query in queries]
+    num_easy = torch.tensor([len(easy_answers[query]) for query in queries])
+    num_answer = torch.tensor([len(answer_list) for answer_list in answer_lists])
+    max_answer = int(num_answer.max())
+    index = torch.tensor([answer_list + [0] * (max_answer - len(answer_list)) for answer_list in answer_lists])
+
+    position = torch.arange(max_answer)
+    valid = position < num_answer.unsqueeze(1)
+    hard = valid & (position >= num_easy.unsqueeze(1))
+    return index.to(device), valid.to(device), hard.to(device)
+
+
+def sorted_ranking(scores):
+    """0-based position of every entity in the descending sort of the scores."""
+    argsort = torch.argsort(scores, dim=1, descending=True)
+    entity_range = torch.arange(scores.shape[1], dtype=torch.float, device=scores.device).expand_as(argsort)
+    return torch.zeros_like(argsort, dtype=torch.float).scatter_(1, argsort, entity_range)
+
+
+def counting_ranking(scores, index, valid):
+    """1-based filtered rank of every packed answer, counting the candidates that score strictly higher instead of sorting.
+
+    Only the answer scores are sorted, every candidate is located among them with searchsorted, so a batch of B queries
+    with A packed answers over N candidates takes O(B N log A) time and O(B (N + A)) memory.
+    """
+    answer_scores = scores.gather(1, index)
+    # invalid slots are sorted first at -inf, so they are never counted as higher-scoring answers
+    sorted_answer_scores, order = torch.sort(answer_scores.masked_fill(~valid, -float('inf')), dim=1)
+    # a candidate is strictly higher than the sorted answers before its position
+    position = torch.searchsorted(sorted_answer_scores, scores.contiguous())
+    counts = torch.zeros(scores.shape[0], index.shape[1] + 1, dtype=torch.long, device=scores.device)
+    counts.scatter_add_(1, position, torch.ones_like(position))
+    sorted_higher = counts.flip(1).cumsum(1).flip(1)[:, 1:]
+    higher = torch.empty_like(sorted_higher).scatter_(1, order, sorted_higher)
+    higher_answers = index.shape[1] - torch.searchsorted(sorted_answer_scores, answer_scores.contiguous(), right=True)
+    return higher - higher_answers + 1
+
+
+def answer_ranking(scores, index, valid, mode):
+    if mode == 'count':
+        return counting_ranking(scores, index, valid)
+    return filtered_ranking(sorted_ranking(scores), index, valid)
+
+
+def filtered_ranking(ranking, index, valid):
+    """1-based filtered rank of every packed answer, given the 0-based position of each entity in the sorted scores.
+
+    The answers of a row hold distinct positions, so once they are sorted an answer is preceded by exactly the answers
+    ranked above it; invalid slots are sorted last and get an infinite rank.
+    """
+    answer_ranking = ranking.gather(1, index).masked_fill(~valid, float('inf'))
+    sorted_ranking, order = torch.sort(answer_ranking, dim=1)
+    position = torch.arange(index.shape[1], dtype=sorted_ranking.dtype, device=sorted_ranking.device)
+    return torch.empty_like(sorted_ranking).scatter_(1, order, sorted_ranking - position + 1)
+
+
+def ranking_metrics(ranking, hard):
+    """Per-query MRR, HITS1, HITS3 and HITS10 averaged over the hard answers."""
+    hard = hard.to(torch.float)
+    ranking = ranking.to(torch.float)
+    metrics = torch.stack([1./ranking, (ranking <= 1).to(torch.float), (ranking <= 3).to(torch.float), (ranking <= 10).to(torch.float)], dim=-1)
+    return (metrics * hard.unsqueeze(-1)).sum(1) / hard.sum(-1, keepdim=True)
+
+
+def bootstrap_interval(values, num_samples, confidence=0.95):
+    """Percentile bootstrap interval of the mean of every column of values (num_queries x num_metrics)."""
+    resample = torch.randint(len(values), (num_samples, len(values)), device=values.device)
+    means = values[resample].mean(1)
+    quantiles = torch.tensor([(1 - confidence) / 2, (1 + confidence) / 2], device=values.device)
+    return torch.quantile(means, quantiles, dim=0)
+
+
+class MetricAccumulator:
+    """Keeps per-structure metric sums on the device and only syncs when the metrics are read.
+
+    With bootstrap > 0 the per-query values are kept as well and every metric gets a 95% bootstrap interval.
+    """
+    def __init__(self, names, bootstrap=0):
+        self.names = names
+        self.bootstrap = bootstrap
+        self.sums = {}
+        self.counts = collections.defaultdict(int)
+        self.values = collections.defaultdict(list)
+
+    def add(self, query_structures, values):
+        batch_idxs = collections.defaultdict(list)
+        for i, query_structure in enumerate(query_structures):
+            batch_idxs[query_structure].append(i)
+        for query_structure, idxs in batch_idxs.items():
+            total = values[idxs].sum(0)
+            if query_structure in self.sums:
+                self.sums[query_structure] += total
+            else:
+                self.sums[query_structure] = total
+            self.counts[query_structure] += len(idxs)
+            if self.bootstrap > 0:
+                self.values[query_structure].append(values[idxs])
+
+    def result(self):
+        metrics = collections.defaultdict(lambda: collections.defaultdict(int))
+        for query_structure in self.sums:
+            for metric, value in zip(self.names, (self.sums[query_structure] / self.counts[query_structure]).tolist()):
+                metrics[query_structure][metric] = value
+            if self.bootstrap > 0:
+                low, high = bootstrap_interval(torch.cat(self.values[query_structure], dim=0), self.bootstrap).tolist()
+                for metric, metric_low, metric_high in zip(self.names, low, high):
+                    metrics[query_structure][metric + '_low'] = metric_low
+                    metrics[query_structure][metric + '_high'] = metric_high
+            metrics[query_structure]['num_queries'] = self.counts[query_structure]
+        return metrics
+
+
+def merge_metrics(shard_metrics):
+    """Merge the per-structure metrics of several shards, weighting each shard by its number of queries.
+
+    Bootstrap intervals cannot be merged this way, the shards must be evaluated without them.
+    """
+    metrics = collections.defaultdict(lambda: collections.defaultdict(int))
+    for one_metrics in shard_metrics:
+        for key, values in one_metrics.items():
+            assert not any(metric.endswith(('_low', '_high')) for metric in values), "bootstrap intervals cannot be merged across shards"
+            for metric, value in values.items():
+                if metric != 'num_queries':
+                    metrics[key][metric] += value * values['num_queries']
+            metrics[key]['num_queries'] += values['num_queries']
+    for key in metrics:
+        for metric in metrics[key]:
+            if metric != 'num_queries':
+                metrics[key][metric] /= metrics[key]['num_queries']
+    return metrics
+
+
+def _test_shard(shard, model, easy_answers, answers, args, dataset, batch_size, num_threads, result_queue):
+    torch.set_num_threads(num_threads)
+    try:
+        dataloader = DataLoader(dataset, batch_size=batch_size, collate_fn=TestDataset.collate_fn)
+        metrics = model.test_step(model, easy_answers, answers, args, dataloader)
+        result_queue.put((shard, {key: dict(values) for key, values in metrics.items()}))
+    except Exception:
+        result_queue.put((shard, traceback.format_exc()))
+
+
+def sharded_test_step(model, easy_answers, answers, args, dataloader):
+    """Run test_step over args.eval_workers forked CPU processes that read the model from shared memory."""
+    assert not args.cuda, "sharded evaluation only runs on CPU"
+    queries = dataloader.dataset.queries
+    num_shards = min(args.eval_workers, len(queries))
+    num_threads = max(1, torch.get_num_threads() // num_shards)
+
+    model.share_memory()
+    # the cache and the ANN index are built once here, under the same tables as test_step, and inherited by the forked shards
+    with torch.no_grad(), model.inference_autocast(args), model.inference_tables(args):
+        model.eval()
+        if args.eval_cache:
+            if args.two_hop:
+                model.refresh_two_hop()
+            model.neighbor_cache = tuple(cache.share_memory_() for cache in model.build_neighbor_cache())
+        if args.ann_topk > 0:
+            model.ann_index = model.build_ann_index(args)
+
+    context = mp.get_context('fork')
+    result_queue = context.SimpleQueue()
+    processes = []
+    shard_metrics = {}
+    try:
+        for shard in range(num_shards):
+            dataset = copy.copy(dataloader.dataset)
+            dataset.queries = queries[shard::num_shards]
+            dataset.len = len(dataset.queries)
+            process = context.Process(target=_test_shard,
+                                      args=(shard, model, easy_answers, answers, args, dataset, dataloader.batch_size, num_threads, result_queue))
+            process.start()
+            processes.append(process)
+        while len(shard_metrics) < num_shards:
+            # a shard that is killed, e.g. by the OOM killer, never reports, so the processes are polled instead of
+            # blocking on the queue; the exit codes are read first, a shard that exited has already written its result
+            exited = [shard for shard, process in enumerate(processes) if process.exitcode is not None]
+            while not result_queue.empty():
+                shard, one_metrics = result_queue.get()
+                if isinstance(one_metrics, str):
+                    raise RuntimeError('evaluation shard %d failed:\n%s' % (shard, one_metrics))
+                shard_metrics[shard] = one_metrics
+            for shard in exited:
+                if shard not in shard_metrics:
+                    raise RuntimeError('evaluation shard %d exited with code %d without reporting its metrics' % (shard, processes[shard].exitcode))
+            pending = [process for shard, process in enumerate(processes) if shard not in shard_metrics]
+            if pending:
+                pending[0].join(timeout=1)
+    except BaseException:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        raise
+    finally:
+        for process in processes:
+            process.join()
+        model.neighbor_cache = None
+        model.ann_index = None
+
+    return merge_metrics([shard_metrics[shard] for shard in range(num_shards)])
@@ -9,11 +9,13 @@ import numpy as np
 import torch
 from torch.utils.data import DataLoader
 from models import KGReasoning
-from dataloader import TestDataset, TrainDataset, SingledirectionalOneShotIterator
+from dataloader import TestDataset, TrainDataset, PartitionBatchSampler, SingledirectionalOneShotIterator
+from evaluation import sharded_test_step
 from tensorboardX import SummaryWriter
 import pickle
+import random
 from collections import defaultdict
-from util import flatten_query, list2tuple, parse_time, set_global_seed, eval_tuple
+from util import flatten_query, list2tuple, parse_time, set_global_seed, eval_tuple, load_entity_order, reorder_dataset
 
 from rule import GraphRule
 from ruledata import Data
@@ -99,6 +101,44 @@ def parse_args(args=None):
     parser.add_argument('-ee', '--ee', action='store_true', help='inductive type includes ee')
     parser.add_argument('-es', '--es', action='store_true', help='inductive type includes es')
     parser.add_argument('-se', '--se', action='store_true', help='inductive type includes se')
+    parser.add_argument('--eval_rank', default='sort', type=str, choices=['sort', 'count'], help='rank answers by a full argsort of the scores or by counting the higher-scoring candidates')
+    parser.add_argument('--eval_chunk_size', default=0, type=int, help='score the candidates in chunks of this many entities during valid/test, 0 scores all at once')
+    parser.add_argument('--joint_eval', action='store_true', help='evaluate the ee/es/se splits as one stream that shares the per-evaluation setup')
+    parser.add_argument('--eval_workers', default=0, type=int, help='split valid/test queries over this many CPU processes sharing the model memory')
+    parser.add_argument('--ann_topk', default=0, type=int, help='score only the top-k candidates retrieved from a partitioned L1 index during valid/test, 0 scores all entities; '
+                             'the index holds prompt-free entity embeddings, so its recall is capped even when every partition is probed')
+    parser.add_argument('--ann_partitions', default=64, type=int, help='number of partitions of the L1 index')
+    parser.add_argument('--ann_probe', default=4, type=int, help='number of partitions probed per query')
+    parser.add_argument('--ann_recall', action='store_true', help='also score all candidates exactly and report the recall of the index against the exact top-k')
+    parser.add_argument('--infer_dtype', default='fp32', type=str, choices=['fp32', 'bf16'], help='precision of valid/test inference, bf16 runs under autocast, gathers from bfloat16 copies of the embedding tables '
+                             'and keeps the neighbor cache in bfloat16')
+    parser.add_argument('--check_infer_dtype', action='store_true', help='compare the test metrics of --infer_dtype against fp32 for the same checkpoint')
+    parser.add_argument('--quick_valid_size', default=0, type=int, help='validate on a fixed sample of this many queries per structure, 0 always validates on the full sets')
+    parser.add_argument('--full_valid_steps', default=50000, type=int, help='run the full validation and test every xx steps when quick validation is on, independently of valid_steps')
+    parser.add_argument('--bootstrap_samples', default=1000, type=int, help='bootstrap resamples for the confidence intervals of quick validation')
+    parser.add_argument('--neighbor_store', default='device', type=str, choices=['device', 'mmap'],
+                        help='keep the neighbor tables on the model device or memory-map them from the data directory')
+    parser.add_argument('--ragged_neighbor', action='store_true',
+                        help='group the entities of a batch by degree into power-of-two widths and run the attentions of every group '
+                             'at its width, masking the padded neighbor slots')
+    parser.add_argument('--fused_attn', action='store_true',
+                        help='packed projections and scaled_dot_product_attention in the neighbor attention')
+    parser.add_argument('--entity_order', default=None, type=str, help='entity order written by reorder.py, all entity ids are renumbered by it on load')
+    parser.add_argument('--train_partition', default=None, type=str, help='entity partition written by partition.py, training batches are drawn partition by partition')
+    parser.add_argument('--partitions_per_batch', default=1, type=int, help='number of partitions the queries of a training batch come from')
+    parser.add_argument('--cross_partition_ratio', default=0.1, type=float, help='fraction of the negatives drawn from all entities instead of the anchor partition')
+    parser.add_argument('--two_hop', action='store_true', help='add the cached first-hop aggregate of every neighbor, i.e. two-hop neighbor context')
+    parser.add_argument('--two_hop_refresh', default=100, type=int, help='recompute the first-hop aggregates every xx training steps')
+    parser.add_argument('--prompt_cache_size', default=4096, type=int,
+                        help='number of prompt encodings kept per (structure, relations) in eval and frozen-encoder training, 0 disables the cache')
+    parser.add_argument('--freeze_prompt_encoder', action='store_true', help='do not train the prompt encoder')
+    parser.add_argument('--packed_prompts', action='store_true', help='encode the prompts of all query structures in a batch with one padded encoder call')
+    parser.add_argument('--prompt_encoder', default='bert', type=str, choices=['bert', 'gru', 'transformer'],
+                        help='query structure encoder, the 3-layer BERT or a compact GRU / 1-layer transformer')
+    parser.add_argument('--query_plan', action='store_true',
+                        help='run every query structure through its flat operation plan instead of the recursive embed_query_*')
+    parser.add_argument('--compile_query_plan', action='store_true', help='torch.compile the relation and intersection steps of the query plans')
+    parser.add_argument('--eval_cache', action='store_true', help='precompute the prompt-independent neighbor embeddings of all entities once per evaluation')
 
     return parser.parse_args(args)
 
@@ -140,11 +180,48 @@ def log_metrics(mode, step, metrics):
     for metric in metrics:
         logging.info('%s %s at step %d: %f' % (mode, metric, step, metrics[metric]))
 
-def evaluate(model, easy_answers, answers, args, dataloader, query_name_dict, mode, step, writer):
+def evaluate(model, easy_answers, answers, args, dataloader, query_name_dict, mode, step, writer, bootstrap=0):
+    if args.eval_workers > 1 and bootstrap == 0:
+        metrics = sharded_test_step(model, easy_answers, answers, args, dataloader)
+    else:
+        metrics = model.test_step(model, easy_answers, answers, args, dataloader, bootstrap)
+    return report_metrics(metrics, query_name_dict, mode, step, writer)
+
+def evaluate_splits(model, splits, args, dataloader, query_name_dict, mode, step, writer):
+    # splits maps ee/es/se to (easy_answers, answers); the dataloader holds the merged queries tagged with their split
+    easy_answers, answers = {}, {}
+    for split, (split_easy_answers, split_answers) in splits.items():
+        easy_answers.update({(split, query): easy_answer for query, easy_answer in split_easy_answers.items()})
+        answers.update({(split, query): answer for query, answer in split_answers.items()})
+
+    if args.eval_workers > 1:
+        metrics = sharded_test_step(model, easy_answers, answers, args, dataloader)
+    else:
+        metrics = model.test_step(model, easy_answers, answers, args, dataloader)
+    all_metrics = {}
+    for split in splits:
+        split_metrics = {query_structure: metrics[(split, query_structure)] for (metric_split, query_structure) in metrics if metric_split == split}
+        all_metrics[split] = report_metrics(split_metrics, query_name_dict, mode + '_' + split, step, writer)
+    return all_metrics
+
+def compare_infer_dtype(model, easy_answers, answers, args, dataloader, query_name_dict, mode):
+    infer_dtype = args.infer_dtype
+    args.infer_dtype = 'fp32'
+    reference_metrics = model.test_step(model, easy_answers, answers, args, dataloader)
+    args.infer_dtype = infer_dtype
+    metrics = model.test_step(model, easy_answers, answers, args, dataloader)
+    for query_structure in reference_metrics:
+        for metric in reference_metrics[query_structure]:
+            if metric == 'num_queries':
+                continue
+            logging.info('%s %s %s: fp32 %f, %s %f, diff %f' % (mode, query_name_dict[query_structure], metric, reference_metrics[query_structure][metric],
+                                                               infer_dtype, metrics[query_structure][metric],
+                                                               metrics[query_structure][metric] - reference_metrics[query_structure][metric]))
+
+def report_metrics(metrics, query_name_dict, mode, step, writer):
     average_metrics = defaultdict(float)
     all_metrics = defaultdict(float)
 
-    metrics = model.test_step(model, easy_answers, answers, args, dataloader)
     num_query_structures = 0
     num_queries = 0
     for query_structure in metrics:
@@ -152,7 +229,8 @@ def evaluate(model, easy_answers, answers, args, dataloader, query_name_dict, mo
         for metric in metrics[query_structure]:
             writer.add_scalar("_".join([mode, query_name_dict[query_structure], metric]), metrics[query_structure][metric], step)
             all_metrics["_".join([query_name_dict[query_structure], metric])] = metrics[query_structure][metric]
-            if metric != 'num_queries':
+            # a bootstrap interval of the cross-structure average is not the average of the per-structure intervals
+            if metric != 'num_queries' and not metric.endswith(('_low', '_high')):
                 average_metrics[metric] += metrics[query_structure][metric]
         num_queries += metrics[query_structure]['num_queries']
         num_query_structures += 1
@@ -165,6 +243,42 @@ def evaluate(model, easy_answers, answers, args, dataloader, query_name_dict, mo
 
     return all_metrics
 
+def build_quick_valid_dataloader(queries, args):
+    # the same stratified sample of every query structure is used at each quick validation
+    rng = random.Random(args.seed)
+    sample_queries = {query_structure: rng.sample(sorted(queries[query_structure]), min(args.quick_valid_size, len(queries[query_structure])))
+                      for query_structure in queries}
+    return DataLoader(
+        TestDataset(
+            flatten_query(sample_queries),
+            args.nentity,
+            args.nrelation,
+        ),
+        batch_size=args.test_batch_size,
+        num_workers=args.cpu_num,
+        collate_fn=TestDataset.collate_fn
+    )
+
+def build_train_iterator(queries, answers, partition, args):
+    dataset = TrainDataset(queries, args.nentity, args.nrelation, args.negative_sample_size, answers, partition, args.cross_partition_ratio)
+    if partition is None:
+        dataloader = DataLoader(
+            dataset,
+            batch_size=args.batch_size,
+            shuffle=True,
+            num_workers=args.cpu_num,
+            collate_fn=TrainDataset.collate_fn
+        )
+    else:
+        # --train_partition: each batch is drawn from a few partitions of the training graph
+        dataloader = DataLoader(
+            dataset,
+            batch_sampler=PartitionBatchSampler(queries, partition, args.batch_size, args.partitions_per_batch),
+            num_workers=args.cpu_num,
+            collate_fn=TrainDataset.collate_fn
+        )
+    return SingledirectionalOneShotIterator(dataloader)
+
 def load_data(args, tasks):
     logging.info("loading data")
     train_queries = pickle.load(open(os.path.join(args.data_path, "train-queries.pkl"), 'rb'))
@@ -190,6 +304,17 @@ def load_data(args, tasks):
     test_es_easy_answers = pickle.load(open(os.path.join(args.data_path, "test-es-easy-answers.pkl"), 'rb'))
     test_se_easy_answers = pickle.load(open(os.path.join(args.data_path, "test-se-easy-answers.pkl"), 'rb'))
 
+    if args.entity_order is not None:
+        # every id the model sees is translated here, the pickles on disk keep the original numbering
+        old2new = load_entity_order(args.entity_order)
+        train_queries, (train_answers,) = reorder_dataset(train_queries, [train_answers], old2new)
+        valid_ee_queries, (valid_ee_answers, valid_ee_easy_answers) = reorder_dataset(valid_ee_queries, [valid_ee_answers, valid_ee_easy_answers], old2new)
+        valid_es_queries, (valid_es_answers, valid_es_easy_answers) = reorder_dataset(valid_es_queries, [valid_es_answers, valid_es_easy_answers], old2new)
+        valid_se_queries, (valid_se_answers, valid_se_easy_answers) = reorder_dataset(valid_se_queries, [valid_se_answers, valid_se_easy_answers], old2new)
+        test_ee_queries, (test_ee_answers, test_ee_easy_answers) = reorder_dataset(test_ee_queries, [test_ee_answers, test_ee_easy_answers], old2new)
+        test_es_queries, (test_es_answers, test_es_easy_answers) = reorder_dataset(test_es_queries, [test_es_answers, test_es_easy_answers], old2new)
+        test_se_queries, (test_se_answers, test_se_easy_answers) = reorder_dataset(test_se_queries, [test_se_answers, test_se_easy_answers], old2new)
+
     logging.info('Load pkl finished!')
     for name in all_tasks:
         if 'u' in name:
@@ -220,11 +345,9 @@ def load_data(args, tasks):
         test_ee_queries, test_es_queries, test_se_queries, test_ee_answers, test_es_answers, test_se_answers, \
         valid_ee_easy_answers, valid_es_easy_answers, valid_se_easy_answers, test_ee_easy_answers, test_es_easy_answers, test_se_easy_answers
 
-def main(args):
-    set_global_seed(args.seed)
-
+def build_relation_mat(args):
+    """Sparse relation matrices of the ns model, renumbered by --entity_order, None for the other geometries."""
     mat = None
-
     if args.geo == 'ns':
         if args.use_rule:
             matpath = os.path.join(args.data_path, 'RuleAddedMat.pkl')
@@ -241,6 +364,31 @@ def main(args):
         else:
             base_data = Data(args.data_path)
             mat = base_data.rel_mat
+        if args.entity_order is not None:
+            old2new = torch.from_numpy(load_entity_order(args.entity_order))
+            mat = [torch.sparse_coo_tensor(old2new[single_mat.indices()], single_mat.values(), single_mat.shape).coalesce() for single_mat in mat]
+    return mat
+
+
+def load_kge_pretrain(model, args):
+    """Load the pretrained KGE entity and relation embeddings of --kge_mode into the model."""
+    pre = torch.load(os.path.join(args.data_path, 'KGEmodel', args.kge_mode+'.ckpt'))
+    pretrained_dict = { 'embedding_range':pre['state_dict']['model.embedding_range'], \
+        'entity_embedding':pre['state_dict']['model.ent_emb.weight'], 'relation_embedding':pre['state_dict']['model.rel_emb.weight']}
+    if args.entity_order is not None:
+        order = torch.from_numpy(np.load(args.entity_order))
+        entity_embedding = pretrained_dict['entity_embedding'].clone()
+        entity_embedding[:len(order)] = pretrained_dict['entity_embedding'][order]
+        pretrained_dict['entity_embedding'] = entity_embedding
+    model_dict = model.state_dict()
+    model_dict.update(pretrained_dict)
+    model.load_state_dict(model_dict)
+
+
+def main(args):
+    set_global_seed(args.seed)
+
+    mat = build_relation_mat(args)
 
 
     tasks = args.tasks.split('.')
@@ -253,6 +401,9 @@ def main(args):
         assert(len(lams) == len(tasks))
         args.lams = {name_query_dict[task if 'u' not in task else f'{task}-{args.evaluate_union}']:lams[i] for i,task in enumerate(tasks)}
 
+    if args.ann_topk > 0:
+        assert args.geo != 'beta', "the L1 candidate index cannot serve the KL scorer of BetaE"
+
     if args.evaluate_union == 'DM':
         assert args.geo == 'beta', "only BetaE supports modeling union using De Morgan's Laws"
 
@@ -320,23 +471,16 @@ def main(args):
                 train_path_queries[query_structure] = train_queries[query_structure]
             else:
                 train_other_queries[query_structure] = train_queries[query_structure]
+        partition = None
+        if args.train_partition is not None:
+            partition = np.load(args.train_partition)
+            if args.entity_order is not None:
+                partition = partition[np.load(args.entity_order)]
         train_path_queries = flatten_query(train_path_queries)
-        train_path_iterator = SingledirectionalOneShotIterator(DataLoader(
-                                    TrainDataset(train_path_queries, nentity, nrelation, args.negative_sample_size, train_answers),
-                                    batch_size=args.batch_size,
-                                    shuffle=True,
-                                    num_workers=args.cpu_num,
-                                    collate_fn=TrainDataset.collate_fn
-                                ))
+        train_path_iterator = build_train_iterator(train_path_queries, train_answers, partition, args)
         if len(train_other_queries) > 0:
             train_other_queries = flatten_query(train_other_queries)
-            train_other_iterator = SingledirectionalOneShotIterator(DataLoader(
-                                        TrainDataset(train_other_queries, nentity, nrelation, args.negative_sample_size, train_answers),
-                                        batch_size=args.batch_size,
-                                        shuffle=True,
-                                        num_workers=args.cpu_num,
-                                        collate_fn=TrainDataset.collate_fn
-                                    ))
+            train_other_iterator = build_train_iterator(train_other_queries, train_answers, partition, args)
         else:
             train_other_iterator = None
 
@@ -345,6 +489,8 @@ def main(args):
         if args.ee:
             for query_structure in valid_ee_queries:
                 logging.info('ee_' +  query_name_dict[query_structure]+": "+str(len(valid_ee_queries[query_structure])))
+            if args.quick_valid_size > 0:
+                valid_ee_quick_dataloader = build_quick_valid_dataloader(valid_ee_queries, args)
             valid_ee_queries = flatten_query(valid_ee_queries)
             valid_ee_dataloader = DataLoader(
                 TestDataset(
@@ -359,6 +505,8 @@ def main(args):
         if args.es:
             for query_structure in valid_es_queries:
                 logging.info('es_' + query_name_dict[query_structure]+": "+str(len(valid_es_queries[query_structure])))
+            if args.quick_valid_size > 0:
+                valid_es_quick_dataloader = build_quick_valid_dataloader(valid_es_queries, args)
             valid_es_queries = flatten_query(valid_es_queries)
             valid_es_dataloader = DataLoader(
                 TestDataset(
@@ -373,6 +521,8 @@ def main(args):
         if args.se:
             for query_structure in valid_se_queries:
                 logging.info('se_' + query_name_dict[query_structure]+": "+str(len(valid_se_queries[query_structure])))
+            if args.quick_valid_size > 0:
+                valid_se_quick_dataloader = build_quick_valid_dataloader(valid_se_queries, args)
             valid_se_queries = flatten_query(valid_se_queries)
             valid_se_dataloader = DataLoader(
                 TestDataset(
@@ -430,6 +580,39 @@ def main(args):
                 collate_fn=TestDataset.collate_fn
             )
 
+    if args.joint_eval:
+        induc_types = [induc_type for induc_type in ['ee', 'es', 'se'] if getattr(args, induc_type)]
+        if args.do_valid:
+            valid_splits = {'ee': (valid_ee_easy_answers, valid_ee_answers), 'es': (valid_es_easy_answers, valid_es_answers),
+                            'se': (valid_se_easy_answers, valid_se_answers)}
+            valid_splits = {induc_type: valid_splits[induc_type] for induc_type in induc_types}
+            valid_joint_queries = {'ee': valid_ee_queries, 'es': valid_es_queries, 'se': valid_se_queries}
+            valid_joint_dataloader = DataLoader(
+                TestDataset(
+                    [(query, query_structure, induc_type) for induc_type in induc_types for query, query_structure in valid_joint_queries[induc_type]],
+                    args.nentity,
+                    args.nrelation,
+                ),
+                batch_size=args.test_batch_size,
+                num_workers=args.cpu_num,
+                collate_fn=TestDataset.collate_fn
+            )
+        if args.do_test:
+            test_splits = {'ee': (test_ee_easy_answers, test_ee_answers), 'es': (test_es_easy_answers, test_es_answers),
+                           'se': (test_se_easy_answers, test_se_answers)}
+            test_splits = {induc_type: test_splits[induc_type] for induc_type in induc_types}
+            test_joint_queries = {'ee': test_ee_queries, 'es': test_es_queries, 'se': test_se_queries}
+            test_joint_dataloader = DataLoader(
+                TestDataset(
+                    [(query, query_structure, induc_type) for induc_type in induc_types for query, query_structure in test_joint_queries[induc_type]],
+                    args.nentity,
+                    args.nrelation,
+                ),
+                batch_size=args.test_batch_size,
+                num_workers=args.cpu_num,
+                collate_fn=TestDataset.collate_fn
+            )
+
     print('Building neighbor graph...')
     inductiveGraph = neighborGraph(args)
     print('Neighbor graph finished!')
@@ -445,7 +628,6 @@ def main(args):
         use_cuda = args.cuda,
         box_mode=eval_tuple(args.box_mode),
         beta_mode = eval_tuple(args.beta_mode),
-        test_batch_size=args.test_batch_size,
         query_name_dict = query_name_dict,
         mat = mat,
         inductiveGraph = inductiveGraph,
@@ -453,6 +635,10 @@ def main(args):
         args = args
     )
 
+    if args.freeze_prompt_encoder:
+        for param in model.bert.parameters():
+            param.requires_grad = False
+
     logging.info('Model Parameter Configuration:')
     num_params = 0
     for name, param in model.named_parameters():
@@ -466,12 +652,7 @@ def main(args):
 
 
     if args.KGE_pretrain:
-        pre = torch.load(os.path.join(args.data_path, 'KGEmodel', args.kge_mode+'.ckpt'))
-        pretrained_dict = { 'embedding_range':pre['state_dict']['model.embedding_range'], \
-            'entity_embedding':pre['state_dict']['model.ent_emb.weight'], 'relation_embedding':pre['state_dict']['model.rel_emb.weight']}
-        model_dict = model.state_dict()
-        model_dict.update(pretrained_dict)
-        model.load_state_dict(model_dict)
+        load_kge_pretrain(model, args)
 
     if args.do_train:
         current_learning_rate = args.learning_rate
@@ -519,6 +700,9 @@ def main(args):
             if step == 2*args.max_steps//3:
                 args.valid_steps *= 4
 
+            if args.two_hop and (step - init_step) % args.two_hop_refresh == 0:
+                model.refresh_two_hop()
+
             with torch.autograd.set_detect_anomaly(True):
                 log = model.train_step(model, optimizer, train_path_iterator, args, step)
             for metric in log:
@@ -548,23 +732,40 @@ def main(args):
                 }
                 save_model(model, optimizer, save_variable_list, args, step)
 
-            if step % args.valid_steps == 0 and step > init_step:
-                if args.do_valid:
-                    logging.info('Evaluating on Valid Dataset...')
+            if step > init_step:
+                # with quick validation, the full validation and test keep their own schedule instead of waiting
+                # for a common multiple of valid_steps (which grows after 2/3 of max_steps) and full_valid_steps
+                quick_valid = args.quick_valid_size > 0 and step % args.valid_steps == 0
+                full_valid = step % (args.full_valid_steps if args.quick_valid_size > 0 else args.valid_steps) == 0
+                if args.do_valid and quick_valid and not full_valid:
+                    logging.info('Quick evaluating on Valid Dataset...')
                     if args.ee:
-                        valid_ee_metrics = evaluate(model, valid_ee_easy_answers, valid_ee_answers, args, valid_ee_dataloader, query_name_dict, 'Valid_ee', step, writer)
+                        valid_ee_metrics = evaluate(model, valid_ee_easy_answers, valid_ee_answers, args, valid_ee_quick_dataloader, query_name_dict, 'Quick_valid_ee', step, writer, args.bootstrap_samples)
                     if args.es:
-                        valid_es_metrics = evaluate(model, valid_es_easy_answers, valid_es_answers, args, valid_es_dataloader, query_name_dict, 'Valid_es', step, writer)
+                        valid_es_metrics = evaluate(model, valid_es_easy_answers, valid_es_answers, args, valid_es_quick_dataloader, query_name_dict, 'Quick_valid_es', step, writer, args.bootstrap_samples)
                     if args.se:
+                        valid_se_metrics = evaluate(model, valid_se_easy_answers, valid_se_answers, args, valid_se_quick_dataloader, query_name_dict, 'Quick_valid_se', step, writer, args.bootstrap_samples)
+
+                if args.do_valid and full_valid:
+                    logging.info('Evaluating on Valid Dataset...')
+                    if args.joint_eval:
+                        valid_metrics = evaluate_splits(model, valid_splits, args, valid_joint_dataloader, query_name_dict, 'Valid', step, writer)
+                    if args.ee and not args.joint_eval:
+                        valid_ee_metrics = evaluate(model, valid_ee_easy_answers, valid_ee_answers, args, valid_ee_dataloader, query_name_dict, 'Valid_ee', step, writer)
+                    if args.es and not args.joint_eval:
+                        valid_es_metrics = evaluate(model, valid_es_easy_answers, valid_es_answers, args, valid_es_dataloader, query_name_dict, 'Valid_es', step, writer)
+                    if args.se and not args.joint_eval:
                         valid_se_metrics = evaluate(model, valid_se_easy_answers, valid_se_answers, args, valid_se_dataloader, query_name_dict, 'Valid_se', step, writer)
 
-                if args.do_test:
+                if args.do_test and full_valid:
                     logging.info('Evaluating on Test Dataset...')
-                    if args.ee:
+                    if args.joint_eval:
+                        test_metrics = evaluate_splits(model, test_splits, args, test_joint_dataloader, query_name_dict, 'Test', step, writer)
+                    if args.ee and not args.joint_eval:
                         test_ee_metrics = evaluate(model, test_ee_easy_answers, test_ee_answers, args, test_ee_dataloader, query_name_dict, 'Test_ee', step, writer)
-                    if args.es:
+                    if args.es and not args.joint_eval:
                         test_es_metrics = evaluate(model, test_es_easy_answers, test_es_answers, args, test_es_dataloader, query_name_dict, 'Test_es', step, writer)
-                    if args.se:
+                    if args.se and not args.joint_eval:
                         test_se_metrics = evaluate(model, test_se_easy_answers, test_se_answers, args, test_se_dataloader, query_name_dict, 'Test_se', step, writer)
 
             if step % args.log_steps == 0:
@@ -589,13 +790,24 @@ def main(args):
 
     if args.do_test:
         logging.info('Evaluating on Test Dataset...')
-        if args.ee:
+        if args.joint_eval:
+            test_metrics = evaluate_splits(model, test_splits, args, test_joint_dataloader, query_name_dict, 'Test', step, writer)
+        if args.ee and not args.joint_eval:
             test_ee_metrics = evaluate(model, test_ee_easy_answers, test_ee_answers, args, test_ee_dataloader, query_name_dict, 'Test_ee', step, writer)
-        if args.es:
+        if args.es and not args.joint_eval:
             test_es_metrics = evaluate(model, test_es_easy_answers, test_es_answers, args, test_es_dataloader, query_name_dict, 'Test_es', step, writer)
-        if args.se:
+        if args.se and not args.joint_eval:
             test_se_metrics = evaluate(model, test_se_easy_answers, test_se_answers, args, test_se_dataloader, query_name_dict, 'Test_se', step, writer)
 
+    if args.do_test and args.check_infer_dtype:
+        logging.info('Comparing %s inference against fp32...' % args.infer_dtype)
+        if args.ee:
+            compare_infer_dtype(model, test_ee_easy_answers, test_ee_answers, args, test_ee_dataloader, query_name_dict, 'Test_ee')
+        if args.es:
+            compare_infer_dtype(model, test_es_easy_answers, test_es_answers, args, test_es_dataloader, query_name_dict, 'Test_es')
+        if args.se:
+            compare_infer_dtype(model, test_se_easy_answers, test_se_answers, args, test_se_dataloader, query_name_dict, 'Test_se')
+
     logging.info("Training finished!!")
 
 if __name__ == '__main__':
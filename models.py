@@ -1,15 +1,20 @@
 #!/usr/bin/python3
-from transformers import BertModel, BertConfig
-from operator import itemgetter
+from prompt_encoder import build_prompt_encoder
 from kge import KGE, KGEcalculate, KGELoss
+from ann import L1PartitionIndex
+from evaluation import MetricAccumulator, pack_answers, answer_ranking, ranking_metrics
 from tqdm import tqdm
 import collections
+import contextlib
+import functools
 import torch.nn.functional as F
 import torch.nn as nn
 
 import logging
+import numpy as np
 import torch
-torch.cuda.set_device(0)
+if torch.cuda.is_available():
+    torch.cuda.set_device(0)
 
 
 structure_sequence = {
@@ -70,6 +75,36 @@ relation_inplace = {
 }
 
 
+@functools.lru_cache(maxsize=None)
+def compile_query_plan(query_structure, whole_query_structure):
+    """Flatten the embed_query_* recursion over query_structure into stack operations, returns them with the number of query columns.
+
+    ('anchor', column, prompt position) pushes an anchor, ('relation', column) and ('negation', column) replace the top of the stack
+    and ('intersection', k) replaces its top k entries by their intersection. The prompt positions come from whole_query_structure,
+    which differs from query_structure for the DNF branches of union queries.
+    """
+    plan = []
+
+    def visit(structure, idx):
+        if all(ele in ['r', 'n'] for ele in structure[-1]):
+            if structure[0] == 'e':
+                plan.append(('anchor', idx, idx_mask[whole_query_structure][idx]))
+                idx += 1
+            else:
+                idx = visit(structure[0], idx)
+            for ele in structure[-1]:
+                plan.append(('negation' if ele == 'n' else 'relation', idx))
+                idx += 1
+        else:
+            for sub_structure in structure:
+                idx = visit(sub_structure, idx)
+            plan.append(('intersection', len(structure)))
+        return idx
+
+    num_columns = visit(query_structure, 0)
+    return tuple(plan), num_columns
+
+
 def Identity(x):
     return x
 
@@ -187,9 +222,43 @@ class FFN(nn.Module):
         return F.relu(self.linear2(F.relu(self.linear1(input))))
 
 
+class PromptCache():
+    """Bounded LRU cache of prompt encoder outputs keyed by (query structure, autocast dtype, token sequence)."""
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def hit_rate(self):
+        return self.hits / max(1, self.hits + self.misses)
+
+
 class KGReasoning(nn.Module):
     def __init__(self, nentity, nrelation, hidden_dim, gamma,
-                 geo, mode, test_batch_size=1,
+                 geo, mode,
                  box_mode=None, use_cuda=False,
                  query_name_dict=None, beta_mode=None, mat=None, inductiveGraph=None, loss_weight=None, args=None):
         super(KGReasoning, self).__init__()
@@ -200,15 +269,13 @@ class KGReasoning(nn.Module):
         self.geo = geo
         self.KGEmode = mode
         self.use_cuda = use_cuda
-        self.batch_entity_range = torch.arange(nentity).to(torch.float).repeat(test_batch_size, 1).cuda(
-        ) if self.use_cuda else torch.arange(nentity).to(torch.float).repeat(test_batch_size, 1)  # used in test_step
         self.query_name_dict = query_name_dict
         if self.geo == 'ns':
             self.register_buffer('mat', torch.stack(mat))
         self.loss_weight = loss_weight
         self.args = args
-        self.one = torch.tensor([1]).cuda()
-        self.thr = torch.Tensor([1e-10]).cuda()
+        self.register_buffer('one', torch.tensor([1]), persistent=False)
+        self.register_buffer('thr', torch.Tensor([1e-10]), persistent=False)
 
         self.gamma = nn.Parameter(
             torch.Tensor([gamma]),
@@ -290,16 +357,30 @@ class KGReasoning(nn.Module):
             b=self.embedding_range.item()
         )
 
+        self.register_buffer('all_entities', torch.arange(nentity), persistent=False)
+
         self.inductiveGraph = inductiveGraph
+        if args.neighbor_store == 'device':
+            self.register_buffer('neighbor_relations', torch.from_numpy(inductiveGraph.relations), persistent=False)
+            self.register_buffer('neighbor_entities', torch.from_numpy(inductiveGraph.entities), persistent=False)
+        self.register_buffer('neighbor_degrees', torch.from_numpy(inductiveGraph.degrees), persistent=False)
+        self.neighbor_staging = None
+        if args.two_hop:
+            # --two_hop: prompt-free first-hop aggregate of every entity, refreshed by refresh_two_hop
+            self.register_buffer('hop_aggregate', torch.zeros(nentity + 1, self.entity_embedding.shape[1]), persistent=False)
+        self.neighbor_cache = None
+        self.ann_index = None
+        # --fused_attn: packed Q/K/V weights of the inductive attentions reused across eval forwards, see packed_weights
+        self.packed_cache = {}
         if self.geo != 'beta':
-            self.entity_mask = torch.ones(self.nentity+1, self.entity_dim).cuda()
+            entity_mask = torch.ones(self.nentity+1, self.entity_dim)
         else:
-            self.entity_mask = torch.ones(self.nentity+1, self.entity_dim*2).cuda()
-        self.entity_mask.requires_grad = False
-        self.entity_mask[-1][:] = 0
-        self.relation_mask = torch.ones(self.nrelation+1, self.relation_dim).cuda()
-        self.relation_mask.requires_grad = False
-        self.relation_mask[-1][:] = 0
+            entity_mask = torch.ones(self.nentity+1, self.entity_dim*2)
+        entity_mask[-1][:] = 0
+        self.register_buffer('entity_mask', entity_mask, persistent=False)
+        relation_mask = torch.ones(self.nrelation+1, self.relation_dim)
+        relation_mask[-1][:] = 0
+        self.register_buffer('relation_mask', relation_mask, persistent=False)
 
         self.inductive_Q = nn.Linear(self.entity_embedding.shape[1], self.entity_embedding.shape[1])
         self.inductive_K = nn.Linear(self.entity_embedding.shape[1], self.entity_embedding.shape[1])
@@ -343,62 +424,354 @@ class KGReasoning(nn.Module):
         tokens = list({x for v in structure_sequence.values() for x in v}) + ['<pad>']
         self.tok2id = {tok: i+self.nrelation for i, tok in enumerate(tokens)}
         self.structure_sequence_id = {k: [self.tok2id[x] for x in v] for k, v in structure_sequence.items()}
-        query_bert_config = BertConfig(vocab_size=self.nrelation+len(tokens), hidden_size=self.entity_embedding.shape[1], num_hidden_layers=3, num_attention_heads=1,
-                                       intermediate_size=512, max_position_embeddings=40, type_vocab_size=1, pad_token_id=self.tok2id['<pad>'])
-        self.bert = BertModel(query_bert_config, add_pooling_layer=False)
+        # one padded template row per structure and the query -> sequence positions of its relation slots,
+        # a batch of prompts is then one index_put of the query relations into the repeated template
+        self.structure_index = {k: i for i, k in enumerate(structure_sequence)}
+        max_length = max(len(v) for v in structure_sequence.values())
+        max_slots = max(len(v) for v in relation_inplace.values())
+        prompt_templates = torch.full((len(structure_sequence), max_length), self.tok2id['<pad>'], dtype=torch.long)
+        prompt_query_slots = torch.zeros(len(structure_sequence), max_slots, dtype=torch.long)
+        prompt_sequence_slots = torch.zeros(len(structure_sequence), max_slots, dtype=torch.long)
+        for k, i in self.structure_index.items():
+            prompt_templates[i, :len(self.structure_sequence_id[k])] = torch.tensor(self.structure_sequence_id[k])
+            prompt_query_slots[i, :len(relation_inplace[k])] = torch.tensor(list(relation_inplace[k].keys()))
+            prompt_sequence_slots[i, :len(relation_inplace[k])] = torch.tensor(list(relation_inplace[k].values()))
+        self.register_buffer('prompt_templates', prompt_templates, persistent=False)
+        self.register_buffer('prompt_query_slots', prompt_query_slots, persistent=False)
+        self.register_buffer('prompt_sequence_slots', prompt_sequence_slots, persistent=False)
+        # the prompt encoder keeps the attribute name bert whatever the backend, so BERT checkpoints still load
+        self.bert = build_prompt_encoder(args.prompt_encoder, self.nrelation+len(tokens), self.entity_embedding.shape[1], self.tok2id['<pad>'])
+        self.prompt_cache = PromptCache(args.prompt_cache_size) if args.prompt_cache_size > 0 else None
+        if args.compile_query_plan and self.geo != 'ns':
+            # the anchors stay eager, embedding_fusing gathers a data-dependent number of neighbors; the compiled steps only take
+            # tensors (the branches of an intersection are stacked before), so they recompile per grad mode and not per structure
+            self.plan_relation = torch.compile(self.plan_relation, dynamic=True)
+            self.intersect_branches = torch.compile(self.intersect_branches, dynamic=True)
+
+    def prompt_encoder_frozen(self):
+        return not any(param.requires_grad for param in self.bert.parameters())
+
+    def encode_prompts(self, batch_queries_dict):
+        """Encode the token sequence of every query, sets query_sequence_embedding and the no-union / union prompts."""
+        # the sequence only depends on the structure and the relations, so its encoding is cached in eval and frozen-encoder training
+        use_cache = self.prompt_cache is not None and (not self.training or self.prompt_encoder_frozen())
+        bert_inputs = {query_structure: self.prompt_tokens(query_structure, batch_queries_dict[query_structure])
+                       for query_structure in batch_queries_dict}
+        if use_cache:
+            bert_outputs = {query_structure: self.cached_prompts(query_structure, bert_input) for query_structure, bert_input in bert_inputs.items()}
+        elif self.args.packed_prompts:
+            bert_outputs = self.packed_prompts(bert_inputs)
+        else:
+            bert_outputs = {query_structure: self.bert(bert_input).last_hidden_state for query_structure, bert_input in bert_inputs.items()}
+
+        self.query_sequence_embedding = dict()
+        no_union_prompt = []
+        union_prompt = []
+        for query_structure in batch_queries_dict:
+            bert_output = bert_outputs[query_structure]
+            self.query_sequence_embedding[query_structure] = bert_output
+            if 'u' not in self.query_name_dict[query_structure]:
+                no_union_prompt.append(bert_output[:, -1])
+            else:
+                union_prompt.append(bert_output[:, -1])
+
+        self.no_union_prompt = torch.cat(no_union_prompt, dim=0) if len(no_union_prompt) > 0 else []
+        self.union_prompt = torch.cat(union_prompt, dim=0) if len(union_prompt) > 0 else []
+
+    def packed_prompts(self, bert_inputs):
+        # --packed_prompts: every structure of the batch in one encoder call, right-padded to the longest sequence
+        # and masked, each structure keeps the first len(sequence) outputs so its last token stays at [:, -1]
+        pad = self.tok2id['<pad>']
+        max_length = max(bert_input.shape[1] for bert_input in bert_inputs.values())
+        packed_input = torch.cat([F.pad(bert_input, (0, max_length - bert_input.shape[1]), value=pad) for bert_input in bert_inputs.values()], dim=0)
+        packed_output = self.bert(packed_input, attention_mask=(packed_input != pad).long()).last_hidden_state
+
+        bert_outputs = {}
+        start = 0
+        for query_structure, bert_input in bert_inputs.items():
+            bert_outputs[query_structure] = packed_output[start:start+len(bert_input), :bert_input.shape[1]]
+            start += len(bert_input)
+        return bert_outputs
+
+    def prompt_tokens(self, query_structure, queries):
+        i = self.structure_index[query_structure]
+        num_slots = len(relation_inplace[query_structure])
+        tokens = self.prompt_templates[i, :len(structure_sequence[query_structure])].repeat(len(queries), 1)
+        tokens[:, self.prompt_sequence_slots[i, :num_slots]] = queries.to(tokens.device)[:, self.prompt_query_slots[i, :num_slots]]
+        return tokens
+
+    def cached_prompts(self, query_structure, bert_input):
+        # the autocast dtype is part of the key, so bf16 and fp32 encodings of the same sequence are never mixed
+        device_type = self.entity_embedding.device.type
+        dtype = torch.get_autocast_dtype(device_type) if torch.is_autocast_enabled(device_type) else None
+        keys = [(query_structure, dtype, tuple(sequence)) for sequence in bert_input.tolist()]
+        outputs = [self.prompt_cache.get(key) for key in keys]
+        missing = list(dict.fromkeys(key for key, output in zip(keys, outputs) if output is None))
+        if len(missing) > 0:
+            # misses are encoded once per distinct sequence, without dropout, as the cached value is reused
+            training = self.bert.training
+            self.bert.eval()
+            with torch.no_grad():
+                bert_output = self.bert(torch.tensor([key[2] for key in missing], device=self.entity_embedding.device)).last_hidden_state
+            self.bert.train(training)
+            # cloned rows, a view would keep the storage of the whole miss batch alive
+            computed = {key: output.clone() for key, output in zip(missing, bert_output)}
+            for key in missing:
+                self.prompt_cache.put(key, computed[key])
+            outputs = [computed[key] if output is None else output for key, output in zip(keys, outputs)]
+        return torch.stack(outputs, dim=0)
 
     def embedding_fusing(self, node, prompt):
-        relations, entities = self.get_nbor(node.cpu().numpy().tolist())
+        if self.args.ragged_neighbor:
+            return self.ragged_fusing(node, prompt)
+        if self.neighbor_cache is not None:
+            type_embeddings, embeddings = self.neighbor_cache[0][node], self.neighbor_cache[1][node]
+        else:
+            # the prompt-independent part is computed once per distinct entity and expanded back before the prompt attention
+            unique_node, inverse = torch.unique(node, return_inverse=True)
+            type_embeddings, embeddings = self.neighbor_embedding(unique_node)
+            type_embeddings, embeddings = type_embeddings[inverse], embeddings[inverse]
+
+        fused_embedding = self.query_attn(type_embeddings, embeddings, prompt)
+
+        return fused_embedding
+
+    def ragged_fusing(self, node, prompt):
+        # --ragged_neighbor: the neighbor attention and the prompt attention both run once per degree bucket at its width,
+        # the prompt is repeated so that every node keeps the prompt of its query
+        prompt = prompt.repeat_interleave(len(node) // prompt.shape[0], dim=0)
+        unique_node, inverse = torch.unique(node, return_inverse=True)
+        fused_embeddings, positions = [], []
+        for index, mask in self.degree_buckets(unique_node):
+            if self.neighbor_cache is not None:
+                type_embeddings = self.neighbor_cache[0][unique_node[index], :mask.shape[1]]
+                embeddings = self.neighbor_cache[1][unique_node[index], :mask.shape[1]]
+            else:
+                type_embeddings, embeddings = self.neighbor_embedding(unique_node[index], mask)
+            # the batch positions whose entity is in this bucket and their row in it
+            bucket_row = torch.full_like(unique_node, -1)
+            bucket_row[index] = torch.arange(len(index), device=index.device)
+            position = torch.nonzero(bucket_row[inverse] >= 0).squeeze(1)
+            row = bucket_row[inverse[position]]
+            fused_embeddings.append(self.query_attn(type_embeddings[row], embeddings[row], prompt[position], mask[row]))
+            positions.append(position)
+        return torch.cat(fused_embeddings, dim=0)[torch.argsort(torch.cat(positions))]
+
+    def neighbor_embedding(self, node, mask=None):
+        relations, entities = self.get_nbor(node)
+        if mask is not None:
+            relations, entities = relations[:, :mask.shape[1]], entities[:, :mask.shape[1]]
 
         type_embeddings, embeddings = self.predict(relations, entities)
 
         # TODO ablation-EI
-        type_embeddings, embeddings = self.exchange_info(type_embeddings, embeddings)
+        type_embeddings, embeddings = self.exchange_info(type_embeddings, embeddings, mask)
 
-        fused_embedding = self.query_attn(type_embeddings, embeddings, prompt)
+        return type_embeddings, embeddings
 
-        return fused_embedding
+    def padded_neighbor_embedding(self, node):
+        # the neighbor embeddings over all max_neighbor slots, --ragged_neighbor computes every degree bucket at its width and zero-pads it
+        if not self.args.ragged_neighbor:
+            return self.neighbor_embedding(node)
+        all_type_embeddings, all_embeddings, positions = [], [], []
+        for index, mask in self.degree_buckets(node):
+            type_embeddings, embeddings = self.neighbor_embedding(node[index], mask)
+            padding = (0, 0, 0, self.args.max_neighbor - mask.shape[1])
+            all_type_embeddings.append(F.pad(type_embeddings * mask.unsqueeze(-1), padding))
+            all_embeddings.append(F.pad(embeddings * mask.unsqueeze(-1), padding))
+            positions.append(index)
+        order = torch.argsort(torch.cat(positions))
+        return torch.cat(all_type_embeddings, dim=0)[order], torch.cat(all_embeddings, dim=0)[order]
+
+    def add_triples(self, triplets, emerge_entities=()):
+        """Insert new triples and emerging entities without rebuilding the neighbor graph.
+
+        Only the changed neighbor rows are copied to the device tables and recomputed in the neighbor cache,
+        so queries anchored on the new entities can be answered right away. With --two_hop the aggregates of the changed rows
+        are recomputed as well, together with the cached rows of every entity that has one of them as a neighbor.
+        Returns the ids of the changed rows.
+        """
+        rows = self.inductiveGraph.update(triplets, emerge_entities)
+        if len(rows) == 0:
+            return rows
+        node = torch.from_numpy(rows).to(self.neighbor_degrees.device)
+        self.neighbor_degrees[node] = torch.from_numpy(self.inductiveGraph.degrees[rows]).to(node.device)
+        if self.args.neighbor_store == 'device':
+            self.neighbor_relations[node] = torch.from_numpy(self.inductiveGraph.relations[rows]).to(node.device)
+            self.neighbor_entities[node] = torch.from_numpy(self.inductiveGraph.entities[rows]).to(node.device)
+
+        if self.args.two_hop:
+            with torch.no_grad():
+                self.hop_aggregate[node] = self.two_hop_aggregate(node).to(self.hop_aggregate.dtype)
+            dependents = np.nonzero(np.isin(self.inductiveGraph.entities[:self.nentity], rows).any(1))[0]
+            node = torch.from_numpy(np.union1d(rows, dependents)).to(node.device)
+
+        if self.neighbor_cache is not None:
+            # the same tables and autocast as build_neighbor_cache in test_step, so the recomputed rows match a full rebuild
+            with torch.no_grad(), self.inference_autocast(self.args), self.inference_tables(self.args):
+                type_embeddings, embeddings = self.padded_neighbor_embedding(node)
+            self.neighbor_cache[0][node] = type_embeddings.to(self.neighbor_cache[0].dtype)
+            self.neighbor_cache[1][node] = embeddings.to(self.neighbor_cache[1].dtype)
+        return rows
+
+    def refresh_two_hop(self, chunk_size=1024):
+        # the mean of the one-hop neighbor embeddings (before the neighbor attention) over the filled slots of every entity,
+        # so the second hop is a single gather in predict, entities without neighbors and the padding entity keep a zero aggregate
+        with torch.no_grad():
+            aggregates = [self.two_hop_aggregate(node) for node in torch.arange(self.nentity, device=self.entity_embedding.device).split(chunk_size)]
+            aggregates.append(torch.zeros_like(aggregates[0][:1]))
+            # the buffer stays fp32, entity_embedding is a bfloat16 copy when this runs inside inference_tables
+            self.hop_aggregate = torch.cat(aggregates, dim=0).to(self.hop_aggregate.dtype)
+
+    def two_hop_aggregate(self, node):
+        relations, entities = self.get_nbor(node)
+        _, embeddings = self.predict(relations, entities, two_hop=False)
+        degrees = self.neighbor_degrees[node.to(self.neighbor_degrees.device)].to(embeddings.device)
+        filled = (torch.arange(embeddings.shape[1], device=embeddings.device) < degrees.unsqueeze(1)).to(embeddings.dtype)
+        return (embeddings * filled.unsqueeze(-1)).sum(1) / degrees.clamp(min=1).unsqueeze(1)
+
+    def degree_buckets(self, node):
+        # --ragged_neighbor: nodes are grouped by degree into power-of-two widths up to max_neighbor, yields the positions of every
+        # group and its slot mask, entities without neighbors keep their first padding slot so the attention is never empty
+        degrees = self.neighbor_degrees[node.to(self.neighbor_degrees.device)].to(node.device).clamp(min=1)
+        widths = torch.pow(2, torch.ceil(torch.log2(degrees.float()))).long().clamp(max=self.args.max_neighbor)
+        for width in torch.unique(widths).tolist():
+            index = torch.nonzero(widths == width).squeeze(1)
+            yield index, torch.arange(width, device=node.device) < degrees[index].unsqueeze(1)
+
+    def inference_autocast(self, args):
+        # --infer_dtype bf16 runs the prompt encoder, the neighbor attention and the scorers under bfloat16 autocast
+        return torch.autocast(self.entity_embedding.device.type, dtype=torch.bfloat16, enabled=args.infer_dtype == 'bf16')
+
+    @contextlib.contextmanager
+    def inference_tables(self, args):
+        # --infer_dtype bf16 also gathers from bfloat16 copies of the embedding tables, autocast leaves the gathers in fp32,
+        # the masks are cast too so that the masking in predict keeps the copies in bfloat16, the fp32 tables are put back on exit
+        if args.infer_dtype != 'bf16':
+            yield
+            return
+        names = [name for name in ['entity_embedding', 'relation_embedding', 'offset_embedding', 'relation_set_embedding', 'entity_mask', 'relation_mask']
+                 if isinstance(getattr(self, name, None), torch.Tensor)]
+        tables = {name: getattr(self, name).data for name in names}
+        for name in names:
+            getattr(self, name).data = tables[name].to(torch.bfloat16)
+        try:
+            yield
+        finally:
+            for name in names:
+                getattr(self, name).data = tables[name]
+
+    def build_neighbor_cache(self, chunk_size=1024):
+        # the neighbor part of embedding_fusing does not depend on the prompt, so in eval it is computed once per entity
+        all_type_embeddings, all_embeddings = [], []
+        for node in torch.arange(self.nentity).split(chunk_size):
+            type_embeddings, embeddings = self.padded_neighbor_embedding(node)
+            all_type_embeddings.append(type_embeddings)
+            all_embeddings.append(embeddings)
+        dtype = torch.bfloat16 if self.args.infer_dtype == 'bf16' else torch.float
+        return torch.cat(all_type_embeddings, dim=0).to(dtype), torch.cat(all_embeddings, dim=0).to(dtype)
+
+    def build_ann_index(self, args, chunk_size=1024):
+        # candidates are indexed by their prompt-free embedding, the mean over the neighbor slots, while the scorers use
+        # the prompt-fused embedding, so the recall against the exact top-k stays capped even when every partition is probed
+        index_embeddings = []
+        for node in torch.arange(self.nentity, device=self.entity_embedding.device).split(chunk_size):
+            if self.neighbor_cache is not None:
+                type_embeddings, embeddings = self.neighbor_cache[0][node], self.neighbor_cache[1][node]
+            else:
+                type_embeddings, embeddings = self.padded_neighbor_embedding(node)
+            index_embeddings.append(((type_embeddings.mean(1) + embeddings.mean(1)) / 2).float().cpu())
+        return L1PartitionIndex(torch.cat(index_embeddings, dim=0).numpy(), args.ann_partitions, seed=args.seed)
+
+    def ann_candidates(self, all_idxs, all_center_embeddings, all_union_idxs, all_union_center_embeddings):
+        # rows with fewer than k hits are padded with -1, the padded slots are scored as entity 0 and dropped in test_step
+        k = self.args.ann_topk
+        shortlist = torch.full((len(all_idxs) + len(all_union_idxs), k), -1, dtype=torch.long)
+        if len(all_idxs) > 0:
+            ids, _ = self.ann_index.search(all_center_embeddings.reshape(len(all_idxs), -1).float().cpu().numpy(), k, self.args.ann_probe)
+            shortlist[all_idxs] = torch.from_numpy(ids)
+        if len(all_union_idxs) > 0:
+            # the two branches of a union query are searched separately and their closest distinct candidates merged
+            ids, distances = self.ann_index.search(all_union_center_embeddings.reshape(2 * len(all_union_idxs), -1).float().cpu().numpy(),
+                                                   k, self.args.ann_probe)
+            ids, distances = ids.reshape(len(all_union_idxs), 2 * k), distances.reshape(len(all_union_idxs), 2 * k)
+            for i, (row_ids, row_distances) in enumerate(zip(ids, distances)):
+                row_ids = row_ids[np.argsort(row_distances, kind='stable')]
+                row_ids = row_ids[row_ids >= 0]
+                _, first = np.unique(row_ids, return_index=True)
+                row_ids = row_ids[np.sort(first)][:k]
+                shortlist[all_union_idxs[i], :len(row_ids)] = torch.from_numpy(row_ids)
+        self.ann_shortlist = shortlist.to(self.entity_embedding.device)
+        return self.ann_shortlist.clamp(min=0)
 
     def get_nbor(self, node):
-        info = torch.tensor(itemgetter(*node)(self.inductiveGraph.graph))
-        if len(node) == 1:
-            info = info.unsqueeze(0)
+        if self.args.neighbor_store == 'mmap':
+            return self.gather_nbor(node)
+        node = node.to(self.neighbor_entities.device)
+        relations = self.neighbor_relations.index_select(0, node).long()
+        entities = self.neighbor_entities.index_select(0, node).long()
+        return relations, entities
 
-        relations, entities = info.transpose(0, 1).cuda()
+    def gather_nbor(self, node):
+        # host-side gather from the memory-mapped tables, staged through a pinned buffer when the model is on the GPU
+        node = node.cpu().numpy()
+        device = self.entity_embedding.device
+        if device.type != 'cuda':
+            relations = torch.from_numpy(self.inductiveGraph.relations[node])
+            entities = torch.from_numpy(self.inductiveGraph.entities[node])
+            return relations.long(), entities.long()
+
+        if self.neighbor_staging is None or self.neighbor_staging.shape[1] < len(node):
+            self.neighbor_staging = torch.empty(2, len(node), self.inductiveGraph.relations.shape[1], dtype=torch.int32).pin_memory()
+        staging = self.neighbor_staging[:, :len(node)]
+        np.take(self.inductiveGraph.relations, node, axis=0, out=staging[0].numpy())
+        np.take(self.inductiveGraph.entities, node, axis=0, out=staging[1].numpy())
+        relations, entities = staging.to(device).long()
         return relations, entities
 
-    def predict(self, relations, entities):
+    def predict(self, relations, entities, two_hop=True):
         self.relation_embedding.data = self.relation_embedding.data * self.relation_mask
         self.relation_set_embedding.data = self.relation_set_embedding.data * self.relation_mask
         self.entity_embedding.data = self.entity_embedding.data * self.entity_mask
 
         type_embeddings = self.relation_set_embedding[relations]
 
+        entity_embeddings = self.entity_embedding[entities]
+        if self.args.two_hop and two_hop:
+            entity_embeddings = (entity_embeddings + self.hop_aggregate[entities]) / 2
+
         if self.geo == 'vec':
-            neighbor_embeddings = self.entity_embedding[entities]
+            neighbor_embeddings = entity_embeddings
             relation_embeddings = self.relation_embedding[relations]
             embeddings = neighbor_embeddings + relation_embeddings
             return type_embeddings, embeddings
 
         elif self.geo == 'box':
-            neighbor_embeddings = self.entity_embedding[entities]
+            neighbor_embeddings = entity_embeddings
             relation_embeddings = self.relation_embedding[relations]
             embeddings = neighbor_embeddings + relation_embeddings
             return type_embeddings, embeddings
 
         elif self.geo == 'beta':
-            neighbor_embeddings = self.entity_regularizer(self.entity_embedding[entities])
+            neighbor_embeddings = self.entity_regularizer(entity_embeddings)
             relation_embeddings = self.relation_embedding[relations]
             embeddings = self.projection_net(neighbor_embeddings, relation_embeddings)
             return type_embeddings, embeddings
 
-    def exchange_info(self, type_embedding, embeddings):
+    def exchange_info(self, type_embedding, embeddings, mask=None):
+        if self.args.fused_attn:
+            embeddings = self.packed_attention(embeddings, self.inductive_Q, self.inductive_K, self.inductive_V, mask)
+            type_embeddings = self.packed_attention(type_embedding, self.inductive_type_Q, self.inductive_type_K, self.inductive_type_V, mask)
+            return type_embeddings, embeddings
+
         query = self.inductive_Q(embeddings)
         key = self.inductive_K(embeddings)
         value = self.inductive_V(embeddings)
 
         key_trans = torch.transpose(key, 1, 2)
         attn = torch.einsum('bnd, bdm -> bnm', [query, key_trans])
+        if mask is not None:
+            attn = attn.masked_fill(~mask.unsqueeze(1), 0)
         embeddings = torch.einsum('bnm, bmd -> bnd', [attn, value])
 
         query = self.inductive_type_Q(type_embedding)
@@ -406,27 +779,62 @@ class KGReasoning(nn.Module):
         value = self.inductive_type_V(type_embedding)
         key_trans = torch.transpose(key, 1, 2)
         attn = torch.einsum('bnd, bdm -> bnm', [query, key_trans])
+        if mask is not None:
+            attn = attn.masked_fill(~mask.unsqueeze(1), 0)
         type_embeddings = torch.einsum('bnm, bmd -> bnd', [attn, value])
 
         return type_embeddings, embeddings
 
-    def query_attn(self, type_embeddings, embeddings, prompt):
+    def packed_attention(self, inputs, query_layer, key_layer, value_layer, mask=None):
+        # --fused_attn: the three projections run as one packed linear, and the unnormalized attention
+        # is multiplied in the order that avoids the larger of the slot x slot and dim x dim products
+        weight, bias = self.packed_weights(query_layer, key_layer, value_layer)
+        query, key, value = F.linear(inputs, weight, bias).chunk(3, dim=-1)
+        if mask is not None:
+            key = key.masked_fill(~mask.unsqueeze(-1), 0)
+        if inputs.shape[1] > query.shape[-1]:
+            return torch.matmul(query, torch.matmul(key.transpose(1, 2), value))
+        return torch.matmul(torch.matmul(query, key.transpose(1, 2)), value)
+
+    def packed_weights(self, query_layer, key_layer, value_layer):
+        # with grad enabled the packed weight is part of the graph of this forward and is concatenated each time,
+        # without it is kept until one of the projections changes, an optimizer step or a checkpoint load bumps
+        # the version of the parameters and moving the model changes their storage
+        params = [layer.weight for layer in [query_layer, key_layer, value_layer]] + [layer.bias for layer in [query_layer, key_layer, value_layer]]
+        if torch.is_grad_enabled():
+            return torch.cat(params[:3], dim=0), torch.cat(params[3:], dim=0)
+        key = tuple((param.data_ptr(), param._version) for param in params)
+        cached = self.packed_cache.get(id(query_layer))
+        if cached is None or cached[0] != key:
+            cached = key, torch.cat(params[:3], dim=0), torch.cat(params[3:], dim=0)
+            self.packed_cache[id(query_layer)] = cached
+        return cached[1], cached[2]
+
+    def query_attn(self, type_embeddings, embeddings, prompt, mask=None):
         # TODO ablation-prompt
         # type_embedding = torch.mean(type_embeddings, dim=1)
         # embedding = torch.mean(embeddings, dim=1)
 
-        type_embedding = self.induc_inter(type_embeddings, prompt)
-        embedding = self.induc_inter(embeddings, prompt)
+        type_embedding = self.induc_inter(type_embeddings, prompt, mask)
+        embedding = self.induc_inter(embeddings, prompt, mask)
 
         # TODO ablation-type
         embedding = (type_embedding + embedding) / 2
 
         return embedding
 
-    def induc_inter(self, embeddings, prompt):
+    def induc_inter(self, embeddings, prompt, mask=None):
         embeddings = embeddings.reshape(prompt.shape[0], embeddings.shape[0]//prompt.shape[0], embeddings.shape[1], embeddings.shape[2])
-        if True or self.geo in ['vec', 'box']:
+        if self.args.fused_attn:
+            # the prompt is a single query over the neighbor slots, with scale 1 this is the softmax attention below
+            query = prompt.view(prompt.shape[0], 1, 1, -1).expand(-1, embeddings.shape[1], -1, -1)
+            attn_mask = None if mask is None else mask.view(prompt.shape[0], embeddings.shape[1], 1, embeddings.shape[2])
+            embedding = F.scaled_dot_product_attention(query.to(embeddings.dtype), embeddings, embeddings, attn_mask=attn_mask, scale=1.)
+            embedding = embedding.view(-1, prompt.shape[1])
+        elif True or self.geo in ['vec', 'box']:
             attn = torch.einsum('ijkd, id -> ijk', [embeddings, prompt])
+            if mask is not None:
+                attn = attn.masked_fill(~mask.view(attn.shape), float('-inf'))
             attn = F.softmax(attn, dim=-1)
             embedding = torch.einsum('ijkd, ijk -> ijd', [embeddings, attn])
             embedding = embedding.view(-1, prompt.shape[1])
@@ -446,6 +854,9 @@ class KGReasoning(nn.Module):
             return self.forward_ns(positive_sample, negative_sample, subsampling_weight, batch_queries_dict, batch_idxs_dict)
 
     def embed_query_box(self, queries, query_structure, idx, query_sequence_embedding, whole_query_structure):
+        if self.args.query_plan and idx == 0:
+            (embedding, offset_embedding), idx = self.run_query_plan(queries, query_structure, query_sequence_embedding, whole_query_structure)
+            return embedding, offset_embedding, idx
         all_relation_flag = True
         for ele in query_structure[-1]:
             if ele not in ['r', 'n']:
@@ -486,6 +897,9 @@ class KGReasoning(nn.Module):
         return embedding, offset_embedding, idx
 
     def embed_query_vec(self, queries, query_structure, idx, query_sequence_embedding, whole_query_structure):
+        if self.args.query_plan and idx == 0:
+            embedding, idx = self.run_query_plan(queries, query_structure, query_sequence_embedding, whole_query_structure)
+            return embedding, idx
         all_relation_flag = True
         for ele in query_structure[-1]:
             if ele not in ['r', 'n']:
@@ -515,6 +929,9 @@ class KGReasoning(nn.Module):
         return embedding, idx
 
     def embed_query_beta(self, queries, query_structure, idx, query_sequence_embedding, whole_query_structure):
+        if self.args.query_plan and idx == 0:
+            embedding, idx = self.run_query_plan(queries, query_structure, query_sequence_embedding, whole_query_structure)
+            return torch.chunk(embedding, 2, dim=-1) + (idx,)
         all_relation_flag = True
         for ele in query_structure[-1]:
             if ele not in ['r', 'n']:
@@ -551,6 +968,9 @@ class KGReasoning(nn.Module):
         return alpha_embedding, beta_embedding, idx
 
     def embed_query_ns(self, queries, query_structure, idx, query_sequence_embedding, whole_query_structure):
+        if self.args.query_plan and idx == 0:
+            (embedding, vector, v2b_logit), idx = self.run_query_plan(queries, query_structure, query_sequence_embedding, whole_query_structure)
+            return embedding, vector, idx, v2b_logit
         all_relation_flag = True
         for ele in query_structure[-1]:
             if ele not in ['r', 'n']:
@@ -596,6 +1016,91 @@ class KGReasoning(nn.Module):
 
         return embedding, vector, idx, v2b_logit
 
+    def run_query_plan(self, queries, query_structure, query_sequence_embedding, whole_query_structure):
+        """Execute the compiled plan of query_structure, returns the final state of the geometry and the number of query columns.
+
+        States are the embedding for vec and beta (alpha and beta concatenated), (embedding, offset) for box
+        and (embedding, vector, v2b_logit) for ns.
+        """
+        plan, num_columns = compile_query_plan(query_structure, whole_query_structure)
+        stack = []
+        for op in plan:
+            if op[0] == 'anchor':
+                stack.append(self.plan_anchor(queries[:, op[1]], query_sequence_embedding[:, op[2]]))
+            elif op[0] == 'relation':
+                stack[-1] = self.plan_relation(stack[-1], queries[:, op[1]])
+            elif op[0] == 'negation':
+                stack[-1] = self.plan_negation(stack[-1], queries[:, op[1]])
+            else:
+                stack[-op[1]:] = [self.plan_intersection(stack[-op[1]:])]
+        return stack[0], num_columns
+
+    def plan_anchor(self, node, prompt):
+        if self.geo == 'box':
+            embedding = self.embedding_fusing(node=node, prompt=prompt)
+            # with --compile_query_plan the zero offset requires grad like the center, so the compiled relation step
+            # sees a single requires_grad pattern per grad mode
+            return embedding, torch.zeros_like(embedding).requires_grad_(self.args.compile_query_plan and embedding.requires_grad)
+        elif self.geo == 'vec':
+            return self.embedding_fusing(node, prompt)
+        elif self.geo == 'beta':
+            return self.entity_regularizer(torch.index_select(self.entity_embedding, dim=0, index=node))
+        elif self.geo == 'ns':
+            return self.embedding_fusing(node=node, prompt=prompt), F.one_hot(node, num_classes=self.nentity).float(), None
+
+    def plan_relation(self, state, relation):
+        if self.geo == 'box':
+            embedding, offset_embedding = state
+            r_embedding = torch.index_select(self.relation_embedding, dim=0, index=relation)
+            r_offset_embedding = torch.index_select(self.offset_embedding, dim=0, index=relation)
+            return embedding + r_embedding, offset_embedding + self.func(r_offset_embedding)
+        elif self.geo == 'vec':
+            return state + torch.index_select(self.relation_embedding, dim=0, index=relation)
+        elif self.geo == 'beta':
+            return self.projection_net(state, torch.index_select(self.relation_embedding, dim=0, index=relation))
+        elif self.geo == 'ns':
+            embedding, vector, _ = state
+            r_embedding = torch.index_select(self.relation_embedding, dim=0, index=relation)
+            embedding = KGEcalculate(self.KGEmode, embedding, r_embedding, self.embedding_range)
+            vector = torch.stack([torch.sparse.mm(self.mat[relation[i]].t(), vector[i].unsqueeze(1)).squeeze(1)
+                                  for i in range(len(relation))])
+            vector = self.my_norm(vector)
+            v2b_logit = self.gamma
+            if not self.args.pre_1p:
+                vector, embedding, v2b_logit = self.enhance(vector, embedding, relation)
+            return embedding, vector, v2b_logit
+
+    def plan_negation(self, state, relation):
+        if self.geo == 'beta':
+            assert (relation == -2).all()
+            return 1./state
+        elif self.geo == 'ns':
+            _, vector, v2b_logit = state
+            vector = self.my_norm(10/self.nentity - vector)
+            return self.vec2emb(vector), vector, v2b_logit
+        assert False, "%s cannot handle queries with negation" % self.geo
+
+    def plan_intersection(self, states):
+        if self.geo == 'box':
+            return self.intersect_branches(torch.stack([state[0] for state in states]), torch.stack([state[1] for state in states]))
+        elif self.geo == 'vec':
+            return self.intersect_branches(torch.stack(states))
+        elif self.geo == 'beta':
+            return self.intersect_branches(torch.stack(states))
+        elif self.geo == 'ns':
+            vector = self.vec_intersection([state[1] for state in states])
+            return self.vec2emb(vector), vector, states[-1][2]
+
+    def intersect_branches(self, embeddings, offset_embeddings=None):
+        # the stacked branch states of plan_intersection, num_branches x batch x dim
+        if self.geo == 'box':
+            return self.center_net(embeddings), self.offset_net(offset_embeddings)
+        elif self.geo == 'vec':
+            return self.center_net(embeddings)
+        elif self.geo == 'beta':
+            alpha_embedding, beta_embedding = self.center_net(*torch.chunk(embeddings, 2, dim=-1))
+            return torch.cat([alpha_embedding, beta_embedding], dim=-1)
+
     def my_norm(self, vector):
         vector11 = vector.masked_fill(vector < self.thr, 0) / torch.max(self.thr, torch.sum(vector, dim=-1).unsqueeze(-1))
         return vector11
@@ -616,7 +1121,7 @@ class KGReasoning(nn.Module):
 
         val, _ = torch.sort(distance, dim=-1)
 
-        ind1 = torch.tensor([i for i in range(len(rels))]).cuda()
+        ind1 = torch.tensor([i for i in range(len(rels))], device=vector.device)
         cnt = vector.bool().sum(-1).long()*2
         thr = val[(ind1, cnt)].unsqueeze(-1)
         distance = distance.masked_fill(distance <= thr, -1e20)
@@ -659,6 +1164,18 @@ class KGReasoning(nn.Module):
         elif self.query_name_dict[query_structure] == 'up-DNF':
             return ('e', ('r', 'r'))
 
+    def chunked_logit(self, negative_sample, idxs, logit_fn):
+        if negative_sample.stride(0) == 0:
+            # all queries share one candidate row, e.g. the implicit all-entity candidates
+            negative_sample = negative_sample[0].expand(len(idxs), -1)
+        else:
+            negative_sample = negative_sample[idxs]
+        # in eval the candidates are scored in chunks along the entity axis, so peak memory does not grow with nentity
+        chunk_size = self.args.eval_chunk_size
+        if self.training or chunk_size <= 0 or negative_sample.shape[1] <= chunk_size:
+            return logit_fn(negative_sample)
+        return torch.cat([logit_fn(chunk) for chunk in negative_sample.split(chunk_size, dim=1)], dim=-1)
+
     def cal_logit_beta(self, entity_embedding, query_dist):
         alpha_embedding, beta_embedding = torch.chunk(entity_embedding, 2, dim=-1)
         entity_dist = torch.distributions.beta.Beta(alpha_embedding, beta_embedding)
@@ -723,21 +1240,23 @@ class KGReasoning(nn.Module):
 
         if type(negative_sample) != type(None):
             if len(all_alpha_embeddings) > 0:
-                negative_sample_regular = negative_sample[all_idxs]
-                batch_size, negative_size = negative_sample_regular.shape
-                negative_embedding = self.entity_regularizer(torch.index_select(
-                    self.entity_embedding, dim=0, index=negative_sample_regular.view(-1)).view(batch_size, negative_size, -1))
-                negative_logit = self.cal_logit_beta(negative_embedding, all_dists)
+                def negative_logit_fn(negative_sample_regular):
+                    batch_size, negative_size = negative_sample_regular.shape
+                    negative_embedding = self.entity_regularizer(torch.index_select(
+                        self.entity_embedding, dim=0, index=negative_sample_regular.reshape(-1)).view(batch_size, negative_size, -1))
+                    return self.cal_logit_beta(negative_embedding, all_dists)
+                negative_logit = self.chunked_logit(negative_sample, all_idxs, negative_logit_fn)
             else:
                 negative_logit = torch.Tensor([]).to(self.entity_embedding.device)
 
             if len(all_union_alpha_embeddings) > 0:
-                negative_sample_union = negative_sample[all_union_idxs]
-                batch_size, negative_size = negative_sample_union.shape
-                negative_embedding = self.entity_regularizer(torch.index_select(
-                    self.entity_embedding, dim=0, index=negative_sample_union.view(-1)).view(batch_size, 1, negative_size, -1))
-                negative_union_logit = self.cal_logit_beta(negative_embedding, all_union_dists)
-                negative_union_logit = torch.max(negative_union_logit, dim=1)[0]
+                def negative_union_logit_fn(negative_sample_union):
+                    batch_size, negative_size = negative_sample_union.shape
+                    negative_embedding = self.entity_regularizer(torch.index_select(
+                        self.entity_embedding, dim=0, index=negative_sample_union.reshape(-1)).view(batch_size, 1, negative_size, -1))
+                    negative_union_logit = self.cal_logit_beta(negative_embedding, all_union_dists)
+                    return torch.max(negative_union_logit, dim=1)[0]
+                negative_union_logit = self.chunked_logit(negative_sample, all_union_idxs, negative_union_logit_fn)
             else:
                 negative_union_logit = torch.Tensor([]).to(self.entity_embedding.device)
             negative_logit = torch.cat([negative_logit, negative_union_logit], dim=0)
@@ -783,6 +1302,9 @@ class KGReasoning(nn.Module):
             all_union_center_embeddings = all_union_center_embeddings.view(all_union_center_embeddings.shape[0]//2, 2, 1, -1)
             all_union_offset_embeddings = all_union_offset_embeddings.view(all_union_offset_embeddings.shape[0]//2, 2, 1, -1)
 
+        if type(negative_sample) != type(None) and self.ann_index is not None:
+            negative_sample = self.ann_candidates(all_idxs, all_center_embeddings, all_union_idxs, all_union_center_embeddings)
+
         if type(subsampling_weight) != type(None):
             subsampling_weight = subsampling_weight[all_idxs+all_union_idxs]
 
@@ -807,21 +1329,23 @@ class KGReasoning(nn.Module):
 
         if type(negative_sample) != type(None):
             if len(all_center_embeddings) > 0:
-                negative_sample_regular = negative_sample[all_idxs]
-                batch_size, negative_size = negative_sample_regular.shape
-                negative_embedding = self.embedding_fusing(node=negative_sample_regular.view(-1),
-                                                           prompt=self.no_union_prompt).view(batch_size, negative_size, -1)
-                negative_logit = self.cal_logit_box(negative_embedding, all_center_embeddings, all_offset_embeddings)
+                def negative_logit_fn(negative_sample_regular):
+                    batch_size, negative_size = negative_sample_regular.shape
+                    negative_embedding = self.embedding_fusing(node=negative_sample_regular.reshape(-1),
+                                                               prompt=self.no_union_prompt).view(batch_size, negative_size, -1)
+                    return self.cal_logit_box(negative_embedding, all_center_embeddings, all_offset_embeddings)
+                negative_logit = self.chunked_logit(negative_sample, all_idxs, negative_logit_fn)
             else:
                 negative_logit = torch.Tensor([]).to(self.entity_embedding.device)
 
             if len(all_union_center_embeddings) > 0:
-                negative_sample_union = negative_sample[all_union_idxs]
-                batch_size, negative_size = negative_sample_union.shape
-                negative_embedding = self.embedding_fusing(node=negative_sample_union.view(-1),
-                                                           prompt=self.union_prompt).view(batch_size, 1, negative_size, -1)
-                negative_union_logit = self.cal_logit_box(negative_embedding, all_union_center_embeddings, all_union_offset_embeddings)
-                negative_union_logit = torch.max(negative_union_logit, dim=1)[0]
+                def negative_union_logit_fn(negative_sample_union):
+                    batch_size, negative_size = negative_sample_union.shape
+                    negative_embedding = self.embedding_fusing(node=negative_sample_union.reshape(-1),
+                                                               prompt=self.union_prompt).view(batch_size, 1, negative_size, -1)
+                    negative_union_logit = self.cal_logit_box(negative_embedding, all_union_center_embeddings, all_union_offset_embeddings)
+                    return torch.max(negative_union_logit, dim=1)[0]
+                negative_union_logit = self.chunked_logit(negative_sample, all_union_idxs, negative_union_logit_fn)
             else:
                 negative_union_logit = torch.Tensor([]).to(self.entity_embedding.device)
             negative_logit = torch.cat([negative_logit, negative_union_logit], dim=0)
@@ -858,6 +1382,9 @@ class KGReasoning(nn.Module):
             all_union_center_embeddings = torch.cat(all_union_center_embeddings, dim=0).unsqueeze(1)
             all_union_center_embeddings = all_union_center_embeddings.view(all_union_center_embeddings.shape[0]//2, 2, 1, -1)
 
+        if type(negative_sample) != type(None) and self.ann_index is not None:
+            negative_sample = self.ann_candidates(all_idxs, all_center_embeddings, all_union_idxs, all_union_center_embeddings)
+
         if type(subsampling_weight) != type(None):
             subsampling_weight = subsampling_weight[all_idxs+all_union_idxs]
 
@@ -882,21 +1409,23 @@ class KGReasoning(nn.Module):
 
         if type(negative_sample) != type(None):
             if len(all_center_embeddings) > 0:
-                negative_sample_regular = negative_sample[all_idxs]
-                batch_size, negative_size = negative_sample_regular.shape
-                negative_embedding = self.embedding_fusing(node=negative_sample_regular.view(-1),
-                                                           prompt=self.no_union_prompt).view(batch_size, negative_size, -1)
-                negative_logit = self.cal_logit_vec(negative_embedding, all_center_embeddings)
+                def negative_logit_fn(negative_sample_regular):
+                    batch_size, negative_size = negative_sample_regular.shape
+                    negative_embedding = self.embedding_fusing(node=negative_sample_regular.reshape(-1),
+                                                               prompt=self.no_union_prompt).view(batch_size, negative_size, -1)
+                    return self.cal_logit_vec(negative_embedding, all_center_embeddings)
+                negative_logit = self.chunked_logit(negative_sample, all_idxs, negative_logit_fn)
             else:
                 negative_logit = torch.Tensor([]).to(self.entity_embedding.device)
 
             if len(all_union_center_embeddings) > 0:
-                negative_sample_union = negative_sample[all_union_idxs]
-                batch_size, negative_size = negative_sample_union.shape
-                negative_embedding = self.embedding_fusing(node=negative_sample_union.view(-1),
-                                                           prompt=self.union_prompt).view(batch_size, 1, negative_size, -1)
-                negative_union_logit = self.cal_logit_vec(negative_embedding, all_union_center_embeddings)
-                negative_union_logit = torch.max(negative_union_logit, dim=1)[0]
+                def negative_union_logit_fn(negative_sample_union):
+                    batch_size, negative_size = negative_sample_union.shape
+                    negative_embedding = self.embedding_fusing(node=negative_sample_union.reshape(-1),
+                                                               prompt=self.union_prompt).view(batch_size, 1, negative_size, -1)
+                    negative_union_logit = self.cal_logit_vec(negative_embedding, all_union_center_embeddings)
+                    return torch.max(negative_union_logit, dim=1)[0]
+                negative_union_logit = self.chunked_logit(negative_sample, all_union_idxs, negative_union_logit_fn)
             else:
                 negative_union_logit = torch.Tensor([]).to(self.entity_embedding.device)
             negative_logit = torch.cat([negative_logit, negative_union_logit], dim=0)
@@ -954,6 +1483,9 @@ class KGReasoning(nn.Module):
         else:
             vectors = all_union_center_vectors.squeeze(1).squeeze(1)
 
+        if type(negative_sample) != type(None) and self.ann_index is not None:
+            negative_sample = self.ann_candidates(all_idxs, all_center_embeddings, all_union_idxs, all_union_center_embeddings)
+
         if type(subsampling_weight) != type(None):
             subsampling_weight = subsampling_weight[all_idxs+all_union_idxs]
 
@@ -989,23 +1521,25 @@ class KGReasoning(nn.Module):
         if type(negative_sample) != type(None):
 
             if len(all_center_embeddings) > 0:
-                negative_sample_regular = negative_sample[all_idxs]
-                batch_size, negative_size = negative_sample_regular.shape
-                negative_embedding = self.embedding_fusing(node=negative_sample_regular.view(-1),
-                                                           prompt=self.no_union_prompt).view(batch_size, negative_size, -1)
-                negative_vector = None
-                negative_logit = self.cal_logit_ns(negative_embedding, negative_vector, all_center_embeddings, all_center_vectors)
+                def negative_logit_fn(negative_sample_regular):
+                    batch_size, negative_size = negative_sample_regular.shape
+                    negative_embedding = self.embedding_fusing(node=negative_sample_regular.reshape(-1),
+                                                               prompt=self.no_union_prompt).view(batch_size, negative_size, -1)
+                    negative_vector = None
+                    return self.cal_logit_ns(negative_embedding, negative_vector, all_center_embeddings, all_center_vectors)
+                negative_logit = self.chunked_logit(negative_sample, all_idxs, negative_logit_fn)
             else:
                 negative_logit = torch.Tensor([]).to(self.entity_embedding.device)
 
             if len(all_union_center_embeddings) > 0:
-                negative_sample_union = negative_sample[all_union_idxs]
-                batch_size, negative_size = negative_sample_union.shape
-                negative_embedding = self.embedding_fusing(node=negative_sample_union.view(-1),
-                                                           prompt=self.union_prompt).view(batch_size, 1, negative_size, -1)
-                negative_vector = None
-                negative_union_logit = self.cal_logit_ns(negative_embedding, negative_vector, all_union_center_embeddings, all_union_center_vectors)
-                negative_union_logit = torch.max(negative_union_logit, dim=1)[0]
+                def negative_union_logit_fn(negative_sample_union):
+                    batch_size, negative_size = negative_sample_union.shape
+                    negative_embedding = self.embedding_fusing(node=negative_sample_union.reshape(-1),
+                                                               prompt=self.union_prompt).view(batch_size, 1, negative_size, -1)
+                    negative_vector = None
+                    negative_union_logit = self.cal_logit_ns(negative_embedding, negative_vector, all_union_center_embeddings, all_union_center_vectors)
+                    return torch.max(negative_union_logit, dim=1)[0]
+                negative_union_logit = self.chunked_logit(negative_sample, all_union_idxs, negative_union_logit_fn)
             else:
                 negative_union_logit = torch.Tensor([]).to(self.entity_embedding.device)
             negative_logit = torch.cat([negative_logit, negative_union_logit], dim=0)
@@ -1034,30 +1568,7 @@ class KGReasoning(nn.Module):
             negative_sample = negative_sample.cuda()
             subsampling_weight = subsampling_weight.cuda()
 
-        self.query_sequence_embedding = dict()
-        self.no_union_prompt = []
-        self.union_prompt = []
-        for query_structure in batch_queries_dict:
-            one_query_structure_queries = []
-            for oneQuery in batch_queries_dict[query_structure]:
-                tmp = self.structure_sequence_id[query_structure].copy()
-                for idx1, idx2 in relation_inplace[query_structure].items():
-                    tmp[idx2] = int(oneQuery[idx1])
-                one_query_structure_queries.append(tmp)
-
-            bert_input = torch.tensor(one_query_structure_queries).cuda()
-
-            bert_output = self.bert(bert_input).last_hidden_state
-            self.query_sequence_embedding[query_structure] = bert_output
-            if 'u' not in self.query_name_dict[query_structure]:
-                self.no_union_prompt.append(bert_output[:, -1])
-            else:
-                self.union_prompt.append(bert_output[:, -1])
-
-        if len(self.no_union_prompt) > 0:
-            self.no_union_prompt = torch.cat(self.no_union_prompt, dim=0)
-        if len(self.union_prompt) > 0:
-            self.union_prompt = torch.cat(self.union_prompt, dim=0)
+        self.encode_prompts(batch_queries_dict)
 
         if args.geo == 'ns':
             _, vector_logit, v2b_logit, positive_logit, negative_logit, subsampling_weight, _ = model(
@@ -1109,15 +1620,36 @@ class KGReasoning(nn.Module):
             }
         return log
 
-    def test_step(self, model, easy_answers, answers, args, test_dataloader):
+    def test_step(self, model, easy_answers, answers, args, test_dataloader, bootstrap=0):
         model.eval()
 
         step = 0
         total_steps = len(test_dataloader)
-        logs = collections.defaultdict(list)
-
-        with torch.no_grad():
-            for negative_sample, queries, queries_unflatten, query_structures in tqdm(test_dataloader, disable=not args.print_on_screen):
+        metric_names = ['MRR', 'HITS1', 'HITS3', 'HITS10']
+        if args.geo == 'ns':
+            metric_names += ['vec_' + metric for metric in metric_names]
+        if args.ann_topk > 0 and args.ann_recall:
+            metric_names += ['ANN_recall']
+        accumulator = MetricAccumulator(metric_names, bootstrap)
+
+        with torch.no_grad(), self.inference_autocast(args), self.inference_tables(args):
+            # a cache or index that is already set was built by the caller, e.g. shared by the sharded evaluation workers
+            shared_cache = self.neighbor_cache is not None
+            shared_ann = self.ann_index is not None
+            if self.prompt_cache is not None:
+                # the logged hit rate covers this evaluation only
+                self.prompt_cache.reset_stats()
+                if not self.prompt_encoder_frozen():
+                    # the encoder may have been trained since the last evaluation
+                    self.prompt_cache.clear()
+            if args.two_hop and not shared_cache:
+                self.refresh_two_hop()
+            if args.eval_cache and not shared_cache:
+                self.neighbor_cache = self.build_neighbor_cache()
+            if args.ann_topk > 0 and not shared_ann:
+                self.ann_index = self.build_ann_index(args)
+
+            for negative_sample, queries, queries_unflatten, query_structures, splits in tqdm(test_dataloader, disable=not args.print_on_screen):
                 batch_queries_dict = collections.defaultdict(list)
                 batch_idxs_dict = collections.defaultdict(list)
                 for i, query in enumerate(queries):
@@ -1128,154 +1660,70 @@ class KGReasoning(nn.Module):
                         batch_queries_dict[query_structure] = torch.LongTensor(batch_queries_dict[query_structure]).cuda()
                     else:
                         batch_queries_dict[query_structure] = torch.LongTensor(batch_queries_dict[query_structure])
-                if args.cuda:
+                if negative_sample is None:
+                    negative_sample = self.all_entities.expand(len(queries), -1)
+                elif args.cuda:
                     negative_sample = negative_sample.cuda()
 
-                self.query_sequence_embedding = dict()
-                no_union_prompt = []
-                union_prompt = []
-                for query_structure in batch_queries_dict:
-                    one_query_structure_queries = []
-                    for oneQuery in batch_queries_dict[query_structure]:
-                        tmp = self.structure_sequence_id[query_structure].copy()
-                        for idx1, idx2 in relation_inplace[query_structure].items():
-                            tmp[idx2] = int(oneQuery[idx1])
-                        one_query_structure_queries.append(tmp)
-
-                    bert_input = torch.tensor(one_query_structure_queries).cuda()
-
-                    bert_output = self.bert(bert_input).last_hidden_state
-                    self.query_sequence_embedding[query_structure] = bert_output
-                    if 'u' not in self.query_name_dict[query_structure]:
-                        no_union_prompt.append(bert_output[:, -1])
-                    else:
-                        union_prompt.append(bert_output[:, -1])
-
-                if len(no_union_prompt) > 0:
-                    self.no_union_prompt = torch.cat(no_union_prompt, dim=0)
-                if len(union_prompt) > 0:
-                    self.union_prompt = torch.cat(union_prompt, dim=0)
+                self.encode_prompts(batch_queries_dict)
 
                 if args.geo == 'ns':
                     vectors, _, _, _, negative_logit, _, idxs = model(None, negative_sample, None, batch_queries_dict, batch_idxs_dict)
                 else:
                     _, negative_logit, _, idxs = model(None, negative_sample, None, batch_queries_dict, batch_idxs_dict)
+                negative_logit = negative_logit.float()
 
                 queries_unflatten = [queries_unflatten[i] for i in idxs]
                 query_structures = [query_structures[i] for i in idxs]
+                candidates = self.ann_shortlist if self.ann_index is not None else negative_sample
+                if self.ann_index is not None and args.ann_recall:
+                    # recall of the shortlist against the exact top-k over the same candidates
+                    ann_index, self.ann_index = self.ann_index, None
+                    exact_logit = model(None, negative_sample, None, batch_queries_dict, batch_idxs_dict)[-3]
+                    self.ann_index = ann_index
+                    exact_topk = negative_sample[idxs].gather(1, exact_logit.topk(min(args.ann_topk, exact_logit.shape[1]), dim=1).indices)
+                    ann_recall = (candidates[idxs].unsqueeze(2) == exact_topk.unsqueeze(1)).any(1).to(torch.float).mean(1, keepdim=True)
+                if candidates.stride(0) != 0:
+                    # partial ranking: entities outside the candidate list are scored below all candidates,
+                    # the -1 padding of short ANN rows goes to a spare column that is dropped
+                    candidates = candidates[idxs].masked_fill(candidates[idxs] < 0, self.nentity)
+                    negative_logit = torch.full((len(idxs), self.nentity + 1), -float('inf'), device=negative_logit.device).scatter_(
+                        1, candidates, negative_logit)[:, :self.nentity]
 
                 if args.gridsearch:
                     negative_logit = torch.softmax(negative_logit, dim=-1)
                     negative_logit = args.lam * negative_logit + (1 - args.lam) * vectors
                 if args.lambdas:
                     negative_logit = torch.softmax(negative_logit, dim=-1)
-                    lams = torch.tensor([args.lams[struct] for struct in query_structures]).cuda()
+                    lams = torch.tensor([args.lams[struct] for struct in query_structures], device=negative_logit.device)
                     negative_logit = lams * negative_logit + (1 - lams) * vectors
 
-                argsort = torch.argsort(negative_logit, dim=1, descending=True)
-                ranking = argsort.clone().to(torch.float)
-                if args.geo == 'ns':
-                    vector_argsort = torch.argsort(vectors, dim=1, descending=True)
-                    vector_ranking = vector_argsort.clone().to(torch.float)
-                if len(argsort) == args.test_batch_size:
-                    ranking = ranking.scatter_(1, argsort, model.batch_entity_range)
-                    if args.geo == 'ns':
-                        vector_ranking = vector_ranking.scatter_(1, vector_argsort, model.batch_entity_range)
-
-                else:
-                    if args.cuda:
-                        ranking = ranking.scatter_(1,
-                                                   argsort,
-                                                   torch.arange(model.nentity).to(torch.float).repeat(argsort.shape[0], 1).cuda()
-                                                   )
-                        if args.geo == 'ns':
-                            vector_ranking = vector_ranking.scatter_(1,
-                                                                     vector_argsort,
-                                                                     torch.arange(model.nentity).to(torch.float).repeat(
-                                                                         vector_argsort.shape[0], 1).cuda()
-                                                                     )
-                    else:
-                        ranking = ranking.scatter_(1,
-                                                   argsort,
-                                                   torch.arange(model.nentity).to(torch.float).repeat(argsort.shape[0], 1)
-                                                   )
-                        if args.geo == 'ns':
-                            vector_ranking = vector_ranking.scatter_(1,
-                                                                     vector_argsort,
-                                                                     torch.arange(model.nentity).to(torch.float).repeat(vector_argsort.shape[0], 1)
-                                                                     )
-                for idx, (i, query, query_structure) in enumerate(zip(argsort[:, 0], queries_unflatten, query_structures)):
-                    answer = answers[query]
-                    easy_answer = easy_answers[query]
-                    num_answer = len(answer)
-                    num_easy = len(easy_answer)
-                    cur_ranking = ranking[idx, list(easy_answer) + list(answer)]
-                    cur_ranking, indices = torch.sort(cur_ranking)
-                    masks = indices >= num_easy
-                    if args.cuda:
-                        answer_list = torch.arange(num_answer + num_easy).to(torch.float).cuda()
-                    else:
-                        answer_list = torch.arange(num_answer + num_easy).to(torch.float)
-                    cur_ranking = cur_ranking - answer_list + 1
-                    cur_ranking = cur_ranking[masks]
-
-                    mrr = torch.mean(1./cur_ranking).item()
-                    h1 = torch.mean((cur_ranking <= 1).to(torch.float)).item()
-                    h3 = torch.mean((cur_ranking <= 3).to(torch.float)).item()
-                    h10 = torch.mean((cur_ranking <= 10).to(torch.float)).item()
-
-                    if args.geo != 'ns':
-                        logs[query_structure].append({
-                            'MRR': mrr,
-                            'HITS1': h1,
-                            'HITS3': h3,
-                            'HITS10': h10,
-                        })
+                if splits[0] is not None:
+                    # answers and metrics of a joint evaluation are keyed by (split, query) and (split, query_structure)
+                    queries_unflatten = [(splits[i], query) for i, query in zip(idxs, queries_unflatten)]
+                    query_structures = [(splits[i], query_structure) for i, query_structure in zip(idxs, query_structures)]
 
+                index, valid, hard = pack_answers(queries_unflatten, easy_answers, answers, negative_logit.device)
+                values = ranking_metrics(answer_ranking(negative_logit, index, valid, args.eval_rank), hard)
                 if args.geo == 'ns':
-
-                    for idx, (i, query, query_structure) in enumerate(zip(vector_argsort[:, 0], queries_unflatten, query_structures)):
-                        answer = answers[query]
-                        easy_answer = easy_answers[query]
-                        num_answer = len(answer)
-                        num_easy = len(easy_answer)
-                        cur_ranking = vector_ranking[idx, list(easy_answer) + list(answer)]
-                        cur_ranking, indices = torch.sort(cur_ranking)
-                        masks = indices >= num_easy
-                        if args.cuda:
-                            answer_list = torch.arange(num_answer + num_easy).to(torch.float).cuda()
-                        else:
-                            answer_list = torch.arange(num_answer + num_easy).to(torch.float)
-                        cur_ranking = cur_ranking - answer_list + 1
-                        cur_ranking = cur_ranking[masks]
-
-                        vec_mrr = torch.mean(1./cur_ranking).item()
-                        vec_h1 = torch.mean((cur_ranking <= 1).to(torch.float)).item()
-                        vec_h3 = torch.mean((cur_ranking <= 3).to(torch.float)).item()
-                        vec_h10 = torch.mean((cur_ranking <= 10).to(torch.float)).item()
-
-                        logs[query_structure].append({
-                            'MRR': mrr,
-                            'HITS1': h1,
-                            'HITS3': h3,
-                            'HITS10': h10,
-                            'vec_MRR': vec_mrr,
-                            'vec_HITS1': vec_h1,
-                            'vec_HITS3': vec_h3,
-                            'vec_HITS10': vec_h10,
-                        })
+                    vector_values = ranking_metrics(answer_ranking(vectors, index, valid, args.eval_rank), hard)
+                    values = torch.cat([values, vector_values], dim=-1)
+                if self.ann_index is not None and args.ann_recall:
+                    values = torch.cat([values, ann_recall], dim=-1)
+                accumulator.add(query_structures, values)
 
                 if step % args.test_log_steps == 0:
                     logging.info('Evaluating the model... (%d/%d)' % (step, total_steps))
 
                 step += 1
 
-        metrics = collections.defaultdict(lambda: collections.defaultdict(int))
-        for query_structure in logs:
-            for metric in logs[query_structure][0].keys():
-                if metric in ['num_hard_answer']:
-                    continue
-                metrics[query_structure][metric] = sum([log[metric] for log in logs[query_structure]])/len(logs[query_structure])
-            metrics[query_structure]['num_queries'] = len(logs[query_structure])
+            if not shared_cache:
+                self.neighbor_cache = None
+            if not shared_ann:
+                self.ann_index = None
+
+        if self.prompt_cache is not None:
+            logging.info('Prompt cache (this evaluation): %d hits, %d misses, hit rate %.4f' % (self.prompt_cache.hits, self.prompt_cache.misses, self.prompt_cache.hit_rate()))
+        metrics = accumulator.result()
 
         return metrics
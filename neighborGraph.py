@@ -1,6 +1,6 @@
 import os
-from collections import defaultdict
-import random
+import numpy as np
+from util import load_entity_order
 
 class neighborGraph:
     def __init__(self, args) -> None:
@@ -11,50 +11,95 @@ class neighborGraph:
             nentity = int(entrel[0].split(' ')[-1])
             nrelation = int(entrel[1].split(' ')[-1])
 
-        emerge_entity = []
-        with open(os.path.join(path, "entities_emerge.txt")) as entity_file:
-            for i, line in enumerate(entity_file):
-                entity = line.strip()
-                emerge_entity.append(entity)
-        entity_file.close()
-
-        graph_entity = defaultdict(list)
-        graph_relation = defaultdict(list)
-
-        with open(os.path.join(path, "entities_emerge.txt")) as entity_file:
-            for i, line in enumerate(entity_file):
-                entity = line.strip()
-                graph_entity[int(entity)] = []
-                graph_relation[int(entity)] = []
-        entity_file.close()
-        with open(os.path.join(path, "entities_train.txt")) as entity_file:
-            for i, line in enumerate(entity_file):
-                entity = line.strip()
-                graph_entity[int(entity)] = []
-                graph_relation[int(entity)] = []
-        entity_file.close()
-
-        shuffle_triplet = []
-        with open(os.path.join(path, "triplets_indexified.txt")) as triplets:
-            for line in triplets:
-                shuffle_triplet.append(line)
-        triplets.close()
-        random.shuffle(shuffle_triplet)
-
-        for i, line in enumerate(shuffle_triplet):
-            h, r, t = line.strip().split('\t')
-            if t not in emerge_entity:
-                graph_relation[int(h)].append(int(r))
-                graph_entity[int(h)].append(int(t))
-
-        for key in graph_entity:
-            if len(graph_entity[key]) < args.max_neighbor:
-                graph_entity[key] = graph_entity[key] + [nentity]*(args.max_neighbor-len(graph_entity[key]))
-                graph_relation[key] = graph_relation[key] + [nrelation]*(args.max_neighbor-len(graph_relation[key]))
-            else:
-                graph_entity[key] = graph_entity[key][0:args.max_neighbor]
-                graph_relation[key] = graph_relation[key][0:args.max_neighbor]
-
-        self.graph = {}
-        for key in graph_entity:
-            self.graph[key] = (graph_relation[key], graph_entity[key])
\ No newline at end of file
+        self.nentity = nentity
+        self.nrelation = nrelation
+        self.max_neighbor = args.max_neighbor
+        emerge_path = os.path.join(path, "entities_emerge.txt")
+        emerge_entity = np.fromfile(emerge_path, dtype=np.int64, sep=' ')
+        self.old2new = None
+        if args.entity_order is not None:
+            self.old2new = load_entity_order(args.entity_order)
+            emerge_entity = self.old2new[emerge_entity]
+        self.is_emerge = np.zeros(nentity, dtype=bool)
+        self.is_emerge[emerge_entity] = True
+
+        triplet_path = os.path.join(path, "triplets_indexified.txt")
+        cache_prefix = os.path.join(path, "neighbor_graph_%d_%d" % (args.max_neighbor, args.seed))
+        # build also drops the edges towards emerging entities, so the tables depend on the emerging entity list
+        source_paths = [triplet_path, emerge_path]
+        if args.entity_order is not None:
+            cache_prefix += '_' + os.path.splitext(os.path.basename(args.entity_order))[0]
+            source_paths.append(args.entity_order)
+        cache_paths = [cache_prefix + '_relations.npy', cache_prefix + '_entities.npy', cache_prefix + '_degrees.npy']
+        if not all(os.path.exists(cache_path) and os.path.getmtime(cache_path) >= max(map(os.path.getmtime, source_paths)) for cache_path in cache_paths):
+            for cache_path, table in zip(cache_paths, self.build(path, args)):
+                tmp_path = '%s.%d.npy' % (cache_path[:-len('.npy')], os.getpid())
+                np.save(tmp_path, table)
+                os.replace(tmp_path, cache_path)
+
+        # --neighbor_store mmap leaves the tables on disk and only pages in the rows that are gathered,
+        # rows changed by update are copied on write and never written back to the cache
+        mmap_mode = 'c' if args.neighbor_store == 'mmap' else None
+        self.relations, self.entities = [np.load(cache_path, mmap_mode=mmap_mode) for cache_path in cache_paths[:2]]
+        self.degrees = np.load(cache_paths[2])
+
+    def build(self, path, args):
+        nentity, nrelation = self.nentity, self.nrelation
+        triplets = np.fromfile(os.path.join(path, "triplets_indexified.txt"), dtype=np.int64, sep=' ').reshape(-1, 3)
+        if self.old2new is not None:
+            triplets[:, [0, 2]] = self.old2new[triplets[:, [0, 2]]]
+        # edges towards emerging entities are not used as neighbors
+        triplets = triplets[~self.is_emerge[triplets[:, 2]]]
+
+        # a seeded shuffle followed by a stable sort on the head keeps a random order within every head,
+        # the first max_neighbor edges of each head are kept
+        triplets = triplets[np.random.default_rng(args.seed).permutation(len(triplets))]
+        triplets = triplets[np.argsort(triplets[:, 0], kind='stable')]
+        heads = triplets[:, 0]
+        first = np.searchsorted(heads, heads, side='left')
+        slot = np.arange(len(triplets)) - first
+        keep = slot < args.max_neighbor
+
+        # dense (nentity+1) x max_neighbor tables, rows of entities without neighbors and the padding row nentity hold padding ids
+        relations = np.full((nentity + 1, args.max_neighbor), nrelation, dtype=np.int32)
+        entities = np.full((nentity + 1, args.max_neighbor), nentity, dtype=np.int32)
+        relations[heads[keep], slot[keep]] = triplets[keep, 1]
+        entities[heads[keep], slot[keep]] = triplets[keep, 2]
+        # the neighbors of every entity fill its first degree slots
+        degrees = np.bincount(heads[keep], minlength=nentity + 1).astype(np.int32)
+        return relations, entities, degrees
+
+    def update(self, triplets, emerge_entities=()):
+        """Insert new (h, r, t) triples and emerging entity ids in place, returns the sorted ids of the changed rows.
+
+        Entity ids must be below nentity, new edges fill the free slots of their head and are dropped once it is full.
+        Edges already pointing at an entity that becomes emerging are removed, as build never keeps them.
+        """
+        emerge_entities = np.asarray(emerge_entities, dtype=np.int64).reshape(-1)
+        triplets = np.asarray(triplets, dtype=np.int64).reshape(-1, 3)
+        assert (emerge_entities < self.nentity).all() and (triplets[:, [0, 2]] < self.nentity).all(), \
+            "the neighbor tables hold nentity entities, new ids must be below it"
+        assert (triplets[:, 1] < self.nrelation).all()
+        newly_emerging = emerge_entities[~self.is_emerge[emerge_entities]]
+        self.is_emerge[emerge_entities] = True
+
+        changed = []
+        if len(newly_emerging) > 0:
+            for h in np.nonzero(np.isin(self.entities[:self.nentity], newly_emerging).any(1))[0]:
+                # the remaining neighbors are moved to the first slots of the row
+                keep = np.nonzero(~self.is_emerge[self.entities[h, :self.degrees[h]]])[0]
+                relations, entities = self.relations[h, keep], self.entities[h, keep]
+                self.relations[h] = self.nrelation
+                self.entities[h] = self.nentity
+                self.relations[h, :len(keep)] = relations
+                self.entities[h, :len(keep)] = entities
+                self.degrees[h] = len(keep)
+                changed.append(h)
+        for h, r, t in triplets[~self.is_emerge[triplets[:, 2]]]:
+            slot = self.degrees[h]
+            if slot < self.max_neighbor:
+                self.relations[h, slot] = r
+                self.entities[h, slot] = t
+                self.degrees[h] += 1
+                changed.append(h)
+        return np.unique(np.asarray(changed, dtype=np.int64))
@@ -0,0 +1,67 @@
+import heapq
+import os
+import click
+import numpy as np
+from reorder import load_triplets
+
+
+def label_propagation(triplets, nentity, num_iterations, seed):
+    """Communities of the undirected graph, every entity repeatedly takes the most frequent label among its neighbors."""
+    rng = np.random.default_rng(seed)
+    heads = np.concatenate([triplets[:, 0], triplets[:, 2]])
+    tails = np.concatenate([triplets[:, 2], triplets[:, 0]])
+    labels = np.arange(nentity)
+    for _ in range(num_iterations):
+        keys, counts = np.unique(heads * nentity + labels[tails], return_counts=True)
+        nodes, neighbor_labels = keys // nentity, keys % nentity
+        # ties go to a random label, the most frequent label of each node comes first after the sort
+        order = np.lexsort((rng.random(len(keys)), -counts, nodes))
+        first = order[np.r_[True, nodes[order][1:] != nodes[order][:-1]]]
+        new_labels = labels.copy()
+        new_labels[nodes[first]] = neighbor_labels[first]
+        # only half of the entities move in each round, which keeps synchronous updates from oscillating
+        update = rng.random(nentity) < 0.5
+        labels = np.where(update, new_labels, labels)
+    return labels
+
+
+def balance_partitions(labels, num_partitions):
+    """Pack the communities into num_partitions partitions, largest community first into the smallest partition.
+
+    Communities larger than a balanced partition are cut into pieces of that size first.
+    """
+    capacity = -(-len(labels) // num_partitions)
+    order = np.argsort(labels, kind='stable')
+    rank = np.arange(len(labels)) - np.searchsorted(labels[order], labels[order], side='left')
+    pieces = np.empty_like(labels)
+    pieces[order] = labels[order] * (len(labels) // capacity + 1) + rank // capacity
+    _, communities, sizes = np.unique(pieces, return_inverse=True, return_counts=True)
+    heap = [(0, partition) for partition in range(num_partitions)]
+    community_partition = np.zeros(len(sizes), dtype=np.int64)
+    for community in np.argsort(-sizes, kind='stable'):
+        load, partition = heapq.heappop(heap)
+        community_partition[community] = partition
+        heapq.heappush(heap, (load + sizes[community], partition))
+    return community_partition[communities]
+
+
+@click.command()
+@click.option('--dataset', default="FB15k-237")
+@click.option('--num_partitions', default=64)
+@click.option('--num_iterations', default=20)
+@click.option('--seed', default=0)
+def main(dataset, num_partitions, num_iterations, seed):
+    base_path = 'data/{0}/'.format(dataset)
+    with open(os.path.join(base_path, 'stats.txt')) as f:
+        nentity = int(f.readline().split(' ')[-1])
+    # partitions come from the training graph only, entities outside it are spread over the partitions as singletons
+    triplets = load_triplets(base_path, 'triplets_train.txt')
+    labels = label_propagation(triplets, nentity, num_iterations, seed)
+    partition = balance_partitions(labels, num_partitions)
+    # partition[entity id] = partition id, pass the file to main.py with --train_partition
+    np.save(os.path.join(base_path, 'entity_partition_{0}.npy'.format(num_partitions)), partition)
+    print('saved {0} partitions of {1} entities, largest {2}'.format(num_partitions, nentity, np.bincount(partition).max()))
+
+
+if __name__ == '__main__':
+    main()
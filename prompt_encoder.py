@@ -0,0 +1,52 @@
+import collections
+import torch
+import torch.nn as nn
+
+
+PromptEncoderOutput = collections.namedtuple('PromptEncoderOutput', ['last_hidden_state'])
+
+
+class GRUPromptEncoder(nn.Module):
+    """Token embedding followed by a single-layer unidirectional GRU.
+
+    Right padding never reaches the outputs of the real tokens, so the attention mask is not needed.
+    """
+    def __init__(self, vocab_size, hidden_size, pad_token_id):
+        super(GRUPromptEncoder, self).__init__()
+        self.embeddings = nn.Embedding(vocab_size, hidden_size, padding_idx=pad_token_id)
+        self.gru = nn.GRU(hidden_size, hidden_size, batch_first=True)
+
+    def forward(self, input_ids, attention_mask=None):
+        hidden_states, _ = self.gru(self.embeddings(input_ids))
+        return PromptEncoderOutput(hidden_states)
+
+
+class TransformerPromptEncoder(nn.Module):
+    """Token and position embeddings followed by one transformer encoder layer with a single head."""
+    def __init__(self, vocab_size, hidden_size, pad_token_id, intermediate_size, max_position_embeddings):
+        super(TransformerPromptEncoder, self).__init__()
+        self.embeddings = nn.Embedding(vocab_size, hidden_size, padding_idx=pad_token_id)
+        self.position_embeddings = nn.Embedding(max_position_embeddings, hidden_size)
+        self.layer = nn.TransformerEncoderLayer(hidden_size, nhead=1, dim_feedforward=intermediate_size, batch_first=True)
+
+    def forward(self, input_ids, attention_mask=None):
+        positions = torch.arange(input_ids.shape[1], device=input_ids.device)
+        hidden_states = self.embeddings(input_ids) + self.position_embeddings(positions)
+        padding_mask = None if attention_mask is None else attention_mask == 0
+        return PromptEncoderOutput(self.layer(hidden_states, src_key_padding_mask=padding_mask))
+
+
+def build_prompt_encoder(encoder, vocab_size, hidden_size, pad_token_id, intermediate_size=512, max_position_embeddings=40):
+    """Prompt encoder backends, each called as encoder(input_ids, attention_mask=None).last_hidden_state."""
+    if encoder == 'bert':
+        # transformers is only imported when the BERT backend is used
+        from transformers import BertModel, BertConfig
+        query_bert_config = BertConfig(vocab_size=vocab_size, hidden_size=hidden_size, num_hidden_layers=3, num_attention_heads=1,
+                                       intermediate_size=intermediate_size, max_position_embeddings=max_position_embeddings, type_vocab_size=1,
+                                       pad_token_id=pad_token_id)
+        return BertModel(query_bert_config, add_pooling_layer=False)
+    elif encoder == 'gru':
+        return GRUPromptEncoder(vocab_size, hidden_size, pad_token_id)
+    elif encoder == 'transformer':
+        return TransformerPromptEncoder(vocab_size, hidden_size, pad_token_id, intermediate_size, max_position_embeddings)
+    raise ValueError('unknown prompt encoder %s' % encoder)
@@ -0,0 +1,60 @@
+import collections
+import os
+import click
+import numpy as np
+
+
+def load_triplets(data_path, file_name="triplets_indexified.txt"):
+    return np.fromfile(os.path.join(data_path, file_name), dtype=np.int64, sep=' ').reshape(-1, 3)
+
+
+def degree_order(triplets, nentity):
+    """Entities by decreasing number of incident edges."""
+    degrees = np.bincount(triplets[:, [0, 2]].reshape(-1), minlength=nentity)
+    return np.argsort(-degrees, kind='stable')
+
+
+def bfs_order(triplets, nentity):
+    """Breadth-first order over the undirected graph, every component starts from its highest-degree entity."""
+    heads = np.concatenate([triplets[:, 0], triplets[:, 2]])
+    tails = np.concatenate([triplets[:, 2], triplets[:, 0]])
+    sort = np.argsort(heads, kind='stable')
+    heads, tails = heads[sort], tails[sort]
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(heads, minlength=nentity))])
+
+    visited = np.zeros(nentity, dtype=bool)
+    order = []
+    for seed in degree_order(triplets, nentity):
+        if visited[seed]:
+            continue
+        visited[seed] = True
+        queue = collections.deque([seed])
+        while queue:
+            entity = queue.popleft()
+            order.append(entity)
+            for neighbor in tails[offsets[entity]:offsets[entity+1]]:
+                if not visited[neighbor]:
+                    visited[neighbor] = True
+                    queue.append(neighbor)
+    return np.asarray(order, dtype=np.int64)
+
+
+@click.command()
+@click.option('--dataset', default="FB15k-237")
+@click.option('--method', default='bfs', type=click.Choice(['bfs', 'degree']))
+def main(dataset, method):
+    base_path = 'data/{0}/'.format(dataset)
+    with open(os.path.join(base_path, 'stats.txt')) as f:
+        nentity = int(f.readline().split(' ')[-1])
+    triplets = load_triplets(base_path)
+    if method == 'bfs':
+        order = bfs_order(triplets, nentity)
+    else:
+        order = degree_order(triplets, nentity)
+    # order[new id] = old id, pass the file to main.py with --entity_order
+    np.save(os.path.join(base_path, 'entity_order_{0}.npy'.format(method)), order)
+    print('saved the {0} order of {1} entities'.format(method, nentity))
+
+
+if __name__ == '__main__':
+    main()
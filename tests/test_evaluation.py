@@ -0,0 +1,65 @@
+import pytest
+import torch
+
+from evaluation import pack_answers, sorted_ranking, filtered_ranking, counting_ranking, merge_metrics
+
+
+def loop_ranking(scores, queries, easy_answers, answers):
+    """Filtered ranks of the hard answers as computed by the original per-query loop of test_step."""
+    ranking = sorted_ranking(scores)
+    rankings = []
+    for idx, query in enumerate(queries):
+        num_easy = len(easy_answers[query])
+        cur_ranking = ranking[idx, list(easy_answers[query]) + list(answers[query])]
+        cur_ranking, indices = torch.sort(cur_ranking)
+        cur_ranking = cur_ranking - torch.arange(len(cur_ranking)).to(torch.float) + 1
+        rankings.append(cur_ranking[indices >= num_easy])
+    return rankings
+
+
+def random_answers(num_queries, nentity, max_answers, generator):
+    easy_answers, answers = {}, {}
+    for query in range(num_queries):
+        num_answers = int(torch.randint(1, max_answers, (1,), generator=generator))
+        entities = torch.randperm(nentity, generator=generator)[:num_answers].tolist()
+        num_easy = int(torch.randint(0, num_answers, (1,), generator=generator))
+        easy_answers[query], answers[query] = set(entities[:num_easy]), set(entities[num_easy:])
+    return easy_answers, answers
+
+
+def test_filtered_ranking_matches_loop():
+    generator = torch.Generator().manual_seed(0)
+    queries = list(range(6))
+    easy_answers, answers = random_answers(len(queries), 3000, 2000, generator)
+    scores = torch.randn(len(queries), 3000, generator=generator)
+
+    index, valid, hard = pack_answers(queries, easy_answers, answers, scores.device)
+    assert index.shape[1] > 1000
+    ranking = filtered_ranking(sorted_ranking(scores), index, valid)
+    for row, expected in enumerate(loop_ranking(scores, queries, easy_answers, answers)):
+        assert torch.equal(torch.sort(ranking[row][hard[row]]).values, expected)
+
+
+def test_counting_ranking_matches_sorted_ranking():
+    generator = torch.Generator().manual_seed(1)
+    queries = list(range(6))
+    easy_answers, answers = random_answers(len(queries), 3000, 2000, generator)
+    # integer scores, so that candidates and answers tie
+    scores = torch.randint(0, 500, (len(queries), 3000), generator=generator).to(torch.float)
+
+    index, valid, hard = pack_answers(queries, easy_answers, answers, scores.device)
+    ranking = counting_ranking(scores, index, valid)
+    answer_scores = scores.gather(1, index)
+    for row in range(len(queries)):
+        row_scores, row_answer_scores = scores[row], answer_scores[row][valid[row]]
+        higher = (row_scores.unsqueeze(0) > row_answer_scores.unsqueeze(1)).sum(-1)
+        higher_answers = (row_answer_scores.unsqueeze(0) > row_answer_scores.unsqueeze(1)).sum(-1)
+        assert torch.equal(ranking[row][valid[row]], higher - higher_answers + 1)
+
+
+def test_merge_metrics_weights_shards_and_rejects_intervals():
+    metrics = merge_metrics([{'1p': {'MRR': 0.5, 'num_queries': 1}}, {'1p': {'MRR': 0.2, 'num_queries': 3}}])
+    assert metrics['1p']['num_queries'] == 4
+    assert abs(metrics['1p']['MRR'] - 0.275) < 1e-6
+    with pytest.raises(AssertionError):
+        merge_metrics([{'1p': {'MRR': 0.5, 'MRR_low': 0.4, 'MRR_high': 0.6, 'num_queries': 1}}])
@@ -0,0 +1,185 @@
+import os
+import random
+
+import numpy as np
+import pytest
+import torch
+from torch.utils.data import DataLoader
+
+import main
+import dataloader
+import evaluation
+from dataloader import TrainDataset, SingledirectionalOneShotIterator
+from models import KGReasoning
+from neighborGraph import neighborGraph
+from util import set_global_seed
+
+NENTITY, NRELATION = 40, 3
+ONE_HOP = ('e', ('r',))
+TWO_HOP = ('e', ('r', 'r'))
+TWO_INTER = (('e', ('r',)), ('e', ('r',)))
+THREE_INTER = (('e', ('r',)), ('e', ('r',)), ('e', ('r',)))
+
+
+def write_graph(data_path):
+    """A random graph in the layout neighborGraph reads, the last five entities are emerging."""
+    rng = np.random.default_rng(0)
+    triplets = np.stack([rng.integers(0, NENTITY, 200), rng.integers(0, NRELATION, 200), rng.integers(0, NENTITY, 200)], axis=1)
+    np.savetxt(data_path / 'triplets_indexified.txt', triplets, fmt='%d')
+    np.savetxt(data_path / 'entities_emerge.txt', np.arange(NENTITY - 5, NENTITY), fmt='%d')
+    (data_path / 'stats.txt').write_text('numentity: %d\nnumrelations: %d\n' % (NENTITY, NRELATION))
+    return triplets
+
+
+def build_model(data_path, geo='vec', extra_args=()):
+    triplets = write_graph(data_path)
+    args = main.parse_args(['--data_path', str(data_path), '--geo', geo, '-d', '8', '-max_n', '4', '-n', '4', '-b', '8',
+                            '--test_batch_size', '4', '-cpu', '0'] + list(extra_args))
+    args.nentity, args.nrelation = NENTITY, NRELATION
+    set_global_seed(0)
+    model = KGReasoning(nentity=NENTITY, nrelation=NRELATION, hidden_dim=8, gamma=12.0, geo=geo, mode='TransE', use_cuda=False,
+                        box_mode=main.eval_tuple(args.box_mode), beta_mode=main.eval_tuple(args.beta_mode),
+                        query_name_dict=main.query_name_dict, inductiveGraph=neighborGraph(args), loss_weight=0.1, args=args)
+
+    answers = {}
+    for h, r, t in triplets:
+        answers.setdefault((int(h), (int(r),)), set()).add(int(t))
+    # answers of the multi-hop structures are random, only the query layout matters here
+    random.seed(0)
+    one_hop = list(answers)
+    queries = [(query, ONE_HOP) for query in one_hop]
+    for i in range(20):
+        (h1, (r1,)), (h2, (r2,)), (h3, (r3,)) = one_hop[i], one_hop[20 + i], one_hop[40 + i]
+        for query, query_structure in [((h1, (r1, r2)), TWO_HOP), (((h1, (r1,)), (h2, (r2,))), TWO_INTER),
+                                       (((h1, (r1,)), (h2, (r2,)), (h3, (r3,))), THREE_INTER)]:
+            answers[query] = set(random.sample(range(NENTITY), 3))
+            queries.append((query, query_structure))
+    return model, args, queries, answers
+
+
+def train_iterator(queries, answers, args):
+    dataset = TrainDataset(queries, NENTITY, NRELATION, args.negative_sample_size, answers)
+    return SingledirectionalOneShotIterator(DataLoader(dataset, batch_size=args.batch_size, shuffle=True, collate_fn=TrainDataset.collate_fn))
+
+
+def eval_dataloader(queries, args):
+    return DataLoader(dataloader.TestDataset(queries, NENTITY, NRELATION), batch_size=args.test_batch_size,
+                      collate_fn=dataloader.TestDataset.collate_fn)
+
+
+def test_bf16_eval_keeps_two_hop_aggregate_fp32(tmp_path):
+    model, args, queries, answers = build_model(tmp_path, extra_args=['--two_hop', '--infer_dtype', 'bf16'])
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    iterator = train_iterator(queries, answers, args)
+
+    model.refresh_two_hop()
+    model.train_step(model, optimizer, iterator, args, 0)
+    assert model.hop_aggregate.dtype == torch.float32
+    model.test_step(model, {query: set() for query, _ in queries}, answers, args, eval_dataloader(queries, args))
+    assert model.hop_aggregate.dtype == torch.float32
+    assert model.entity_embedding.dtype == torch.float32
+    model.refresh_two_hop()
+    model.train_step(model, optimizer, iterator, args, 1)
+    assert model.hop_aggregate.dtype == torch.float32
+
+
+def run_train_eval(model, args, queries, answers, cycles=6):
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    iterator = train_iterator(queries, answers, args)
+    easy_answers = {query: set() for query, _ in queries}
+    for step in range(cycles):
+        model.train_step(model, optimizer, iterator, args, step)
+        metrics = model.test_step(model, easy_answers, answers, args, eval_dataloader(queries, args))
+    return metrics
+
+
+def test_compiled_query_plan_does_not_fall_back(tmp_path):
+    torch._dynamo.reset()
+    model, args, queries, answers = build_model(tmp_path, geo='box', extra_args=['--query_plan', '--compile_query_plan'])
+    # every compiled step needs at most a static, a dynamic and a batch-size-1 graph per grad mode, a further
+    # recompile raises instead of silently running eager
+    with torch._dynamo.config.patch(recompile_limit=6, fail_on_recompile_limit_hit=True):
+        metrics = run_train_eval(model, args, queries, answers)
+    assert torch._dynamo.utils.counters['stats']['unique_graphs'] > 0
+
+    # the same weights through the eager steps
+    del model.plan_relation, model.intersect_branches
+    eager_metrics = model.test_step(model, {query: set() for query, _ in queries}, answers, args, eval_dataloader(queries, args))
+    for query_structure in eager_metrics:
+        for metric in ['MRR', 'HITS1', 'HITS3', 'HITS10']:
+            assert abs(metrics[query_structure][metric] - eager_metrics[query_structure][metric]) < 1e-4
+
+
+class NullWriter:
+    def add_scalar(self, *args):
+        pass
+
+
+def test_report_metrics_leaves_intervals_out_of_the_average():
+    metrics = {ONE_HOP: {'MRR': 0.5, 'MRR_low': 0.4, 'MRR_high': 0.6, 'num_queries': 10},
+               TWO_HOP: {'MRR': 0.3, 'MRR_low': 0.1, 'MRR_high': 0.5, 'num_queries': 10}}
+    all_metrics = main.report_metrics(metrics, {ONE_HOP: '1p', TWO_HOP: '2p'}, 'Test', 0, NullWriter())
+    assert abs(all_metrics['average_MRR'] - 0.4) < 1e-6
+    assert 'average_MRR_low' not in all_metrics and 'average_MRR_high' not in all_metrics
+    assert all_metrics['1p_MRR_low'] == 0.4
+
+
+def test_sharded_eval_matches_test_step(tmp_path):
+    model, args, queries, answers = build_model(tmp_path, extra_args=['--infer_dtype', 'bf16', '--eval_cache', '--ann_topk', '10',
+                                                                      '--ann_partitions', '4', '--eval_workers', '2'])
+    easy_answers = {query: set() for query, _ in queries}
+    metrics = model.test_step(model, easy_answers, answers, args, eval_dataloader(queries, args))
+    sharded_metrics = evaluation.sharded_test_step(model, easy_answers, answers, args, eval_dataloader(queries, args))
+    assert model.neighbor_cache is None and model.ann_index is None
+    assert model.entity_embedding.dtype == torch.float32
+    for query_structure in metrics:
+        for metric in metrics[query_structure]:
+            assert abs(metrics[query_structure][metric] - sharded_metrics[query_structure][metric]) < 1e-6
+
+
+def test_sharded_eval_raises_when_a_shard_dies(tmp_path):
+    model, args, queries, answers = build_model(tmp_path, extra_args=['--eval_workers', '2'])
+    # the forked shards inherit the instance attribute and exit without reporting, as if they were killed
+    model.test_step = lambda *args: os._exit(1)
+    with pytest.raises(RuntimeError, match='without reporting'):
+        evaluation.sharded_test_step(model, {query: set() for query, _ in queries}, answers, args, eval_dataloader(queries, args))
+
+
+def test_add_triples_recomputes_cache_rows_like_a_rebuild(tmp_path):
+    model, args, queries, answers = build_model(tmp_path, extra_args=['--infer_dtype', 'bf16', '--eval_cache'])
+    model.eval()
+    with torch.no_grad(), model.inference_autocast(args), model.inference_tables(args):
+        model.neighbor_cache = model.build_neighbor_cache()
+    rows = model.add_triples(np.zeros((0, 3)), emerge_entities=[0])
+    assert len(rows) > 0
+    with torch.no_grad(), model.inference_autocast(args), model.inference_tables(args):
+        rebuilt = model.build_neighbor_cache()
+    for cache, rebuilt_cache in zip(model.neighbor_cache, rebuilt):
+        assert torch.equal(cache, rebuilt_cache)
+
+
+def test_prompt_cache_stats_cover_one_evaluation(tmp_path):
+    model, args, queries, answers = build_model(tmp_path)
+    easy_answers = {query: set() for query, _ in queries}
+    model.test_step(model, easy_answers, answers, args, eval_dataloader(queries, args))
+    first = (model.prompt_cache.hits, model.prompt_cache.misses)
+    assert sum(first) > 0
+    model.test_step(model, easy_answers, answers, args, eval_dataloader(queries, args))
+    assert (model.prompt_cache.hits, model.prompt_cache.misses) == first
+
+
+def test_packed_attention_weights_follow_updates(tmp_path):
+    model, args, queries, answers = build_model(tmp_path, extra_args=['--fused_attn'])
+    easy_answers = {query: set() for query, _ in queries}
+    layers = (model.inductive_Q, model.inductive_K, model.inductive_V)
+    model.test_step(model, easy_answers, answers, args, eval_dataloader(queries, args))
+    with torch.no_grad():
+        weight, _ = model.packed_weights(*layers)
+        assert model.packed_weights(*layers)[0] is weight
+
+    run_train_eval(model, args, queries, answers, cycles=1)
+    with torch.no_grad():
+        updated_weight, updated_bias = model.packed_weights(*layers)
+    assert not torch.equal(updated_weight, weight)
+    assert torch.equal(updated_weight, torch.cat([layer.weight for layer in layers], dim=0))
+    assert torch.equal(updated_bias, torch.cat([layer.bias for layer in layers], dim=0))
@@ -1,3 +1,4 @@
+import collections
 import numpy as np
 import random
 import torch
@@ -46,4 +47,30 @@ def flatten_query(queries):
     for query_structure in queries:
         tmp_queries = list(queries[query_structure])
         all_queries.extend([(query, query_structure) for query in tmp_queries])
-    return all_queries
\ No newline at end of file
+    return all_queries
+
+def load_entity_order(path):
+    """Read an entity order written by reorder.py and return the old id -> new id map."""
+    order = np.load(path)
+    old2new = np.empty_like(order)
+    old2new[order] = np.arange(len(order))
+    return old2new
+
+def reorder_query(query, query_structure, old2new):
+    if query_structure == 'e':
+        return int(old2new[query])
+    if isinstance(query_structure, tuple):
+        return tuple(reorder_query(sub_query, sub_structure, old2new) for sub_query, sub_structure in zip(query, query_structure))
+    return query
+
+def reorder_dataset(queries, answer_dicts, old2new):
+    """Translate the anchors of queries (structure -> set of queries) and the answers keyed by those queries to the new ids."""
+    new_queries = collections.defaultdict(set)
+    new_answer_dicts = [collections.defaultdict(set) for _ in answer_dicts]
+    for query_structure in queries:
+        for query in queries[query_structure]:
+            new_query = reorder_query(query, query_structure, old2new)
+            new_queries[query_structure].add(new_query)
+            for answers, new_answers in zip(answer_dicts, new_answer_dicts):
+                new_answers[new_query] = set(old2new[np.fromiter(answers[query], dtype=np.int64)].tolist())
+    return new_queries, new_answer_dicts